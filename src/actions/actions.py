@@ -0,0 +1,101 @@
+#!/usr/local/sbin/charm-env python3
+#
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+
+# Load modules from $CHARM_DIR/lib
+sys.path.append('lib')
+
+from charms.layer import basic
+basic.bootstrap_charm_deps()
+basic.init_config_states()
+
+import charmhelpers.core.hookenv as ch_hookenv  # noqa: E402
+
+from charm.openstack import cinder_lvm  # noqa: E402
+
+
+def storage_timings(*args):
+    """Report the timings of the last storage configuration."""
+    report = cinder_lvm.latest_timing_report()
+    if report is None:
+        ch_hookenv.action_set({'message': 'No storage configuration has '
+                                          'been timed yet'})
+        return
+    ch_hookenv.action_set({
+        'summary': cinder_lvm.format_timing_summary(report),
+        'report': json.dumps(report, indent=2),
+    })
+
+
+def benchmark(*args):
+    """Run fio profiles against a temporary logical volume."""
+    params = ch_hookenv.action_get()
+    results = cinder_lvm.run_benchmark(
+        group=params.get('group') or None,
+        profiles=(params.get('profiles') or '').split(),
+        size=params.get('size') or '1G',
+        runtime=params.get('runtime'),
+        iodepth=params.get('iodepth'))
+    # Nested keys make the results structured in the action output.
+    output = {}
+    for profile, directions in results.items():
+        for direction, result in directions.items():
+            for key, value in result.items():
+                output['{}.{}.{}'.format(profile, direction, key)] = value
+    ch_hookenv.action_set(output)
+
+
+def evacuate_device(*args):
+    """Move the data off a physical volume and remove it from its VG."""
+    params = ch_hookenv.action_get()
+    result = cinder_lvm.evacuate_device(
+        params['device'],
+        targets=(params.get('target') or '').split(),
+        bandwidth=params.get('bandwidth'),
+        chunk_size=params.get('chunk-size') or '1G',
+        thin_pools=params.get('thin-pools', True),
+        progress=ch_hookenv.function_log)
+    result['remaining-lvs'] = ','.join(result['remaining-lvs'])
+    ch_hookenv.action_set(result)
+
+
+# A dictionary of all the defined actions to callables (which take
+# parsed arguments).
+ACTIONS = {
+    'benchmark': benchmark,
+    'evacuate-device': evacuate_device,
+    'storage-timings': storage_timings,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return "Action {} undefined".format(action_name)
+    else:
+        try:
+            action(args)
+        except Exception as e:
+            ch_hookenv.action_fail(str(e))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -13,39 +13,57 @@
 # limitations under the License.
 
 
+import collections
+import contextlib
+import datetime
+import fnmatch
+import functools
+import ipaddress
+import json
+import os
+import re
 import subprocess
 import socket
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+import charms.reactive as reactive
 import charms_openstack.charm
 import charmhelpers.core.hookenv as ch_hookenv
 
+from charmhelpers.core import unitdata
+
 from charmhelpers.core.strutils import (
     bytes_from_string,
 )
 
+from charmhelpers.fetch import (
+    apt_install,
+    filter_installed_packages,
+)
+
 from charmhelpers.core.host import (
     mounts,
     umount,
+    write_file,
 )
 
 from charmhelpers.contrib.storage.linux.utils import (
     is_block_device,
     zap_disk,
-    is_device_mounted,
 )
 
 from charmhelpers.contrib.storage.linux.loopback import (
-    ensure_loopback_device,
+    loopback_devices,
 )
 
 from charmhelpers.contrib.storage.linux.lvm import (
     create_lvm_physical_volume,
     create_lvm_volume_group,
     deactivate_lvm_volume_group,
-    extend_logical_volume_by_device,
     is_lvm_physical_volume,
-    list_lvm_volume_group,
-    list_thin_logical_volume_pools,
     remove_lvm_physical_volume,
 )
 
@@ -54,12 +72,270 @@ charms_openstack.charm.use_defaults('charm.default-select-release')
 
 
 DEFAULT_LOOPBACK_SIZE = '5G'
+LOOPBACK_ALLOCATIONS = ('sparse', 'preallocate')
+LOOPBACK_BLOCK_SIZES = (512, 1024, 2048, 4096)
 VOLUME_DRIVER = "cinder.volume.drivers.lvm.LVMVolumeDriver"
 VOLUMES_DIR = "/var/lib/cinder/volumes"
 VOLUME_NAME_TEMPLATE = "volume-%s"
+STORAGE_FINGERPRINT_KEY = 'storage-fingerprint'
+EVACUATED_DEVICES_KEY = 'evacuated-devices'
+CONSUMED_DEVICES_KEY = 'consumed-devices'
+LVM_DEVICE_FILTER_KEY = 'lvm-device-filter'
+VOLUME_GROUP_SIZES_KEY = 'volume-group-sizes'
+ERASE_FAILURES_KEY = 'erase-failures'
+VOLUME_COPY_LIMIT_KEY = 'volume-copy-bps-limit'
+DISK_BY_ID_DIR = '/dev/disk/by-id'
+PV_UUID_LINK_PREFIX = 'lvm-pv-uuid-'
+DEVICE_GROUP_RE = re.compile(r'^[a-z0-9][a-z0-9-]*$')
+DEVICE_PATTERN_RE = re.compile(r'[*?[]')
+LVM_SIZE_RE = re.compile(r'^[0-9]+[KMGTP]$', re.IGNORECASE)
+THIN_ALLOCATION_TYPES = ('thin', 'auto')
+DEFAULT_THIN_POOL_SIZE = '95%'
+THIN_POOL_DISCARDS = ('passdown', 'nopassdown', 'ignore')
+NVMET_TARGET_HELPERS = ('nvmet', 'spdk-nvmeof')
+NVMET_TARGET_PROTOCOLS = ('nvmet_rdma', 'nvmet_tcp')
+ISCSI_IOTYPES = ('blockio', 'fileio', 'auto')
+LV_LAYOUTS = ('linear', 'striped', 'raid1', 'raid10')
+RAID_LAYOUTS = ('raid1', 'raid10')
+DEFAULT_RAID_POOL_METADATA_SIZE = '1G'
+VOLUME_CLEAR_METHODS = ('none', 'zero', 'discard')
+IMAGE_CACHE_SIZE_RE = re.compile(r'^([0-9]+)(%?)$')
+DD_BLOCKSIZE_RE = re.compile(r'^[0-9]+[KMG]?$')
+CGROUP_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+# Used for the volume copies when every device of a backend is solid state.
+SOLID_STATE_DD_BLOCKSIZE = '4M'
+DEFAULT_COPY_CGROUP = 'cinder-volume-copy'
+BLKIO_CGROUP_DIR = '/sys/fs/cgroup/blkio'
+DEFAULT_IMAGE_CACHE_SIZE = '10%'
+DEVICE_WIPE_MODES = ('zap', 'signatures', 'erase')
+ERASE_LV_PREFIX = 'cinder-lvm-erase-'
+ERASE_STATE_DIR = '/var/lib/cinder-lvm/erase'
+ERASE_SCRIPT = 'files/cinder-lvm-erase'
+# Failed runs of an erase before it is left for the operator to look at.
+ERASE_MAX_FAILURES = 3
+QUEUE_ATTRIBUTES = ('scheduler', 'rotational', 'read_ahead_kb', 'nr_requests')
+UDEV_TUNING_RULES = '/etc/udev/rules.d/60-cinder-lvm-{}.rules'
+LVM_LOCAL_CONF = '/etc/lvm/lvmlocal.conf'
+LVM_LOCAL_CONF_BEGIN = '# BEGIN cinder-lvm charm managed settings'
+LVM_LOCAL_CONF_END = '# END cinder-lvm charm managed settings'
+LVM_FILTER_SPECIAL_CHARS = set('.+*?()[]{}^$|\\')
+LOOPBACK_FILTER = 'a|^/dev/loop[0-9]+$|'
+REMOTE_TRANSPORTS = ('iscsi',)
+DEFAULT_THIN_POOL_AUTOEXTEND_THRESHOLD = 80
+DEFAULT_THIN_POOL_AUTOEXTEND_PERCENT = 20
+THIN_POOL_PROFILE = 'cinder-lvm-thin-pool'
+CACHE_MODES = ('writethrough', 'writeback', 'writecache')
+DEFAULT_CACHE_MODE = 'writethrough'
+# Leave room on the cache devices for the cache pool metadata.
+CACHE_EXTENTS = '95%PVS'
+THIN_POOL_PROFILE_PATH = '/etc/lvm/profile/{}.profile'.format(
+    THIN_POOL_PROFILE)
+DEFAULT_METRICS_DIR = '/var/lib/prometheus/node-exporter'
+METRICS_FILE = 'cinder_lvm.prom'
+# Name and help of each metric, in the order they are written.
+METRICS = (
+    ('cinder_lvm_vg_size_bytes', 'Size of the volume group.'),
+    ('cinder_lvm_vg_free_bytes', 'Free space in the volume group.'),
+    ('cinder_lvm_vg_pv_count', 'Physical volumes in the volume group.'),
+    ('cinder_lvm_vg_missing_pv_count',
+     'Missing physical volumes of the volume group.'),
+    ('cinder_lvm_thin_pool_size_bytes', 'Size of the thin pool.'),
+    ('cinder_lvm_thin_pool_data_percent',
+     'Percentage of the thin pool data space in use.'),
+    ('cinder_lvm_thin_pool_metadata_percent',
+     'Percentage of the thin pool metadata space in use.'),
+)
+BENCHMARK_LV = 'cinder-lvm-benchmark'
+# fio arguments of the benchmark profiles.
+BENCHMARK_PROFILES = collections.OrderedDict([
+    ('randread-4k', ['--rw=randread', '--bs=4k']),
+    ('randwrite-4k', ['--rw=randwrite', '--bs=4k']),
+    ('mixed-4k', ['--rw=randrw', '--rwmixread=70', '--bs=4k']),
+    ('seqread-1m', ['--rw=read', '--bs=1m']),
+    ('seqwrite-1m', ['--rw=write', '--bs=1m']),
+])
+# fio completion latency percentiles, and the names they are reported as.
+BENCHMARK_PERCENTILES = (('50.000000', 'p50'), ('99.000000', 'p99'),
+                         ('99.900000', 'p999'))
+TIMINGS_DIR = '/var/lib/cinder-lvm/timings'
+TIMINGS_KEPT = 10
+PROFILES_DIR = '/var/lib/cinder-lvm/profiles'
+THIN_POOL_PROFILE_TEMPLATE = """# Managed by the cinder-lvm charm.
+activation {{
+    thin_pool_autoextend_threshold = {threshold}
+    thin_pool_autoextend_percent = {percent}
+}}
+"""
+
+
+class StepTimer(object):
+    """Record the duration and outcome of the steps of a hook run.
+
+    Steps may be recorded from several threads at once. The report of a run
+    is written as JSON to a directory, TIMINGS_DIR by default, keeping the
+    last TIMINGS_KEPT runs.
+    """
+
+    def __init__(self, directory=None, title='Storage configuration'):
+        self.directory = directory
+        self.title = title
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.steps = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def step(self, name, target=None):
+        """Time a step, recording the exit code of a failed command.
+
+        :param name: str: Name of the step (ex. 'vgextend').
+        :param target: str: Device, volume group or LV the step acts on.
+        """
+        record = {'step': name, 'target': target, 'exit-code': 0}
+        start = time.monotonic()
+        try:
+            yield record
+        except subprocess.CalledProcessError as e:
+            record['exit-code'] = e.returncode
+            raise
+        except Exception as e:
+            record['exit-code'] = None
+            record['error'] = str(e)
+            raise
+        finally:
+            record['duration'] = round(time.monotonic() - start, 3)
+            with self._lock:
+                self.steps.append(record)
+
+    def add(self, name, duration, target=None):
+        """Record a step which was timed by other means.
+
+        :param name: str: Name of the step.
+        :param duration: float: Duration of the step in seconds.
+        :param target: str: Device, volume group or LV the step acts on.
+        """
+        with self._lock:
+            self.steps.append({'step': name, 'target': target,
+                               'exit-code': 0,
+                               'duration': round(duration, 3)})
+
+    def slowest(self):
+        """Return the record of the slowest step, or None."""
+        return max(self.steps, key=lambda record: record['duration'],
+                   default=None)
+
+    def report(self):
+        """Return the report of the hook run as a dict."""
+        return {
+            'title': self.title,
+            'hook': ch_hookenv.hook_name(),
+            'started': datetime.datetime.fromtimestamp(
+                self.started, datetime.timezone.utc).isoformat(),
+            'duration': round(time.time() - self.started, 3),
+            'slowest': self.slowest(),
+            'steps': self.steps,
+        }
+
+    def write_report(self):
+        """Write the report of the hook run and log its summary."""
+        report = self.report()
+        ch_hookenv.log(format_timing_summary(report))
+        directory = self.directory or TIMINGS_DIR
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, '{}-{}.json'.format(
+                int(self.started * 1000), report['hook']))
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            for old in sorted(os.listdir(directory))[:-TIMINGS_KEPT]:
+                os.remove(os.path.join(directory, old))
+        except OSError as e:
+            ch_hookenv.log('Unable to write timing report: {}'.format(e),
+                           level=ch_hookenv.WARNING)
+
+
+TIMER = StepTimer()
+HOOK_TIMER = StepTimer(PROFILES_DIR, 'Hook dispatch')
+
+
+def timed(name):
+    """Decorate a function so that its calls are recorded by TIMER.
+
+    The first argument of the function is recorded as the target of the
+    step when it is a string.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            target = args[0] if args and isinstance(args[0], str) else None
+            with TIMER.step(name, target):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def latest_timing_report():
+    """Return the report of the last hook run that configured storage.
+
+    :returns: dict: The report, or None if there is none.
+    """
+    try:
+        reports = sorted(os.listdir(TIMINGS_DIR))
+    except OSError:
+        return None
+    if not reports:
+        return None
+    with open(os.path.join(TIMINGS_DIR, reports[-1])) as f:
+        return json.load(f)
+
 
+def profile_hook(started):
+    """Record the import and handler dispatch timings of the hook run.
 
-def get_backend_name():
+    Does nothing unless the 'hook-profiling' option is set. Otherwise the
+    time spent importing the charm code is recorded, every reactive handler
+    dispatched is timed, and the report is written to PROFILES_DIR when the
+    hook exits, at which point handlers are dispatched as before again.
+
+    :param started: float: Time the import of the charm code started at, as
+                           returned by time.time().
+    """
+    if not ch_hookenv.config('hook-profiling'):
+        return
+    HOOK_TIMER.reset()
+    HOOK_TIMER.started = started
+    HOOK_TIMER.add('import', time.time() - started)
+    invoke = reactive.bus.Handler.invoke
+
+    def timed_invoke(handler):
+        with HOOK_TIMER.step('dispatch', handler.id()):
+            return invoke(handler)
+
+    def write_report():
+        reactive.bus.Handler.invoke = invoke
+        HOOK_TIMER.write_report()
+
+    reactive.bus.Handler.invoke = timed_invoke
+    ch_hookenv.atexit(write_report)
+
+
+def format_timing_summary(report):
+    """Return a one line summary of a timing report."""
+    summary = '{} in {} hook took {}s'.format(
+        report.get('title', 'Storage configuration'), report['hook'],
+        report['duration'])
+    slowest = report.get('slowest')
+    if slowest:
+        summary += ', slowest step: {}{} ({}s)'.format(
+            slowest['step'],
+            ' {}'.format(slowest['target']) if slowest['target'] else '',
+            slowest['duration'])
+    return summary
+
+
+def get_backend_name(group=None):
     hostname = socket.gethostname()
     alias = ch_hookenv.config('alias')
     unique_backend = ch_hookenv.config('unique-backend')
@@ -72,37 +348,309 @@ def get_backend_name():
     else:
         backend_name = 'LVM-{}'.format(alias)
 
+    if group:
+        backend_name = '{}-{}'.format(backend_name, group)
     return backend_name
 
 
-def get_volume_group_name():
+def get_volume_group_name(group=None):
     vg_name = ch_hookenv.config('volume-group')
-    return vg_name or 'cinder-volumes-{}'.format(ch_hookenv.config('alias'))
+    vg_name = vg_name or 'cinder-volumes-{}'.format(
+        ch_hookenv.config('alias'))
+    if group:
+        vg_name = '{}-{}'.format(vg_name, group)
+    return vg_name
+
+
+def get_device_groups(devices=None):
+    '''Group the configured block devices by performance class.
+
+    Devices may be prefixed with the name of a group followed by a colon
+    (ex. fast:nvme0n1 bulk:sdb), in which case each group gets its own
+    volume group and backend. Devices without a prefix belong to the
+    default group, None, which uses the unsuffixed names.
+
+    :param devices: str: Space-separated devices, defaults to the
+                         'block-device' option, minus the devices evacuated
+                         with the evacuate-device action.
+    :returns: OrderedDict: Mapping of group names to lists of devices, in
+                           order of first appearance. Always contains at
+                           least one group.
+    :raises ValueError: if a group name is invalid.
+    '''
+    if devices is None:
+        return _skip_evacuated_devices(
+            get_device_groups(ch_hookenv.config('block-device') or 'none'),
+            unitdata.kv())
+    groups = collections.OrderedDict()
+    if devices not in [None, 'None', 'none']:
+        for device in devices.split():
+            (group, device) = _split_device_group(device)
+            group_devices = groups.setdefault(group, [])
+            # Several entries may resolve to the same disk.
+            group_devices.extend(resolved
+                                 for resolved in _resolve_block_device(device)
+                                 if resolved not in group_devices)
+    return groups or collections.OrderedDict([(None, [])])
+
+
+def _resolve_block_device(device):
+    '''Resolve a WWN or a device pattern into stable device paths.
+
+    WWNs (wwn-0x...) are looked up in /dev/disk/by-id. Glob patterns are
+    matched against the names of the /dev/disk/by-id links of whole disks
+    (ex. nvme-SAMSUNG_MZQL2*), or against their full path if absolute. Each
+    matching disk is returned once, under its stable link. Other entries are
+    returned as they are.
+
+    :param device: str: Block device entry from the configuration.
+    :returns: list: Devices the entry stands for.
+    '''
+    if device.startswith('wwn-'):
+        return [os.path.join(DISK_BY_ID_DIR, device)]
+    if not DEVICE_PATTERN_RE.search(device):
+        return [device]
+    links = _stable_device_links()
+    matches = set()
+    for name, path in _disk_id_links():
+        if fnmatch.fnmatch(os.path.join(DISK_BY_ID_DIR, name)
+                           if device.startswith('/') else name, device):
+            matches.add(links[path])
+    if not matches:
+        ch_hookenv.log('No block device matches {}'.format(device),
+                       level=ch_hookenv.WARNING)
+    return sorted(matches)
+
+
+def _split_device_group(device):
+    """Split a 'group:device' entry into its group and device."""
+    if device.startswith('/') or ':' not in device:
+        return (None, device)
+    (group, device) = device.split(':', 1)
+    if not DEVICE_GROUP_RE.match(group):
+        raise ValueError("Invalid block device group '{}', must only contain "
+                         "lowercase letters, digits and dashes".format(group))
+    return (group, device)
 
 
 def configure_block_devices():
+    """Configure the volume groups of the configured block devices.
+
+    :returns: bool: True if storage was configured, False if it already
+                    matched the configuration.
+    """
     e_mountpoint = ch_hookenv.config('ephemeral-unmount')
     if e_mountpoint and filesystem_mounted(e_mountpoint):
         umount(e_mountpoint)
 
     conf = ch_hookenv.config()
+    kv = unitdata.kv()
+    groups = get_device_groups()
+    evacuated = kv.get(EVACUATED_DEVICES_KEY)
+    if evacuated:
+        ch_hookenv.log('Skipping evacuated devices {}, remove them from '
+                       'block-device'.format(', '.join(evacuated)),
+                       level=ch_hookenv.WARNING)
+    thin_pool = get_thin_pool_options()
+    tuning = get_block_device_tuning()
+    cache = get_cache_options()
+    loopback = get_loopback_options()
+    cache_groups = get_device_groups(
+        ' '.join(cache['devices']) if cache else '')
+    for group, devices in cache_groups.items():
+        if devices:
+            groups.setdefault(group, [])
+
     block_devices = []
-    if conf['block-device'] not in [None, 'None', 'none']:
-        block_devices.extend(conf['block-device'].split())
+    for group, devices in groups.items():
+        block_devices.extend(devices + cache_groups.get(group, []))
+    _log_new_block_devices(block_devices, kv)
+    settings = {
+        'groups': [[group, get_volume_group_name(group), devices]
+                   for group, devices in groups.items()],
+        'overwrite': conf['overwrite'],
+        'remove-missing': conf['remove-missing'],
+        'remove-missing-force': conf['remove-missing-force'],
+        'thin-pool': thin_pool,
+        'tuning': tuning,
+        'cache': cache,
+        'loopback': loopback,
+    }
+    if kv.get(STORAGE_FINGERPRINT_KEY) == storage_fingerprint(block_devices,
+                                                              settings):
+        ch_hookenv.log('LVM storage already matches configuration, '
+                       'skipping', level=ch_hookenv.DEBUG)
+        return False
+
+    # Sizes change with the storage, they are read again once it is done.
+    kv.set(VOLUME_GROUP_SIZES_KEY, None)
+    if ch_hookenv.config('lvm-device-filter'):
+        # The device filter has to accept new devices before they can be
+        # initialized.
+        write_lvm_local_config(get_lvm_local_config())
+
+    if block_devices:
         ch_hookenv.status_set('maintenance',
                               'Checking configuration of lvm storage')
-    # Note that there may be None now, and remove-missing is set to true,
-    # so we still have to run the function regardless of whether
-    # block_devices is an empty list or not.
-    configure_lvm_storage(block_devices,
-                          get_volume_group_name(),
-                          conf['overwrite'],
-                          conf['remove-missing'],
-                          conf['remove-missing-force'])
+    TIMER.reset()
+    failures = {}
+    skipped = []
+    try:
+        for group, devices in groups.items():
+            group_cache = None
+            if cache_groups.get(group):
+                group_cache = dict(cache, devices=cache_groups[group])
+                devices = devices + [device for device in cache_groups[group]
+                                     if device not in devices]
+            # Note that there may be None now, and remove-missing is set to
+            # true, so we still have to run the function regardless of
+            # whether devices is an empty list or not.
+            volume_group = get_volume_group_name(group)
+            try:
+                with TIMER.step('configure-volume-group', volume_group):
+                    skipped += configure_lvm_storage(
+                        devices,
+                        volume_group,
+                        conf['overwrite'],
+                        conf['remove-missing'],
+                        conf['remove-missing-force'],
+                        ch_hookenv.config('prepare-concurrency'),
+                        thin_pool,
+                        tuning,
+                        group_cache,
+                        loopback,
+                        get_device_wipe())
+            except DevicePreparationError as e:
+                failures.update(e.failures)
+    finally:
+        TIMER.write_report()
+    if failures:
+        raise DevicePreparationError(failures)
+    kv.set(CONSUMED_DEVICES_KEY, sorted(set(block_devices)))
+    if skipped:
+        # Cleaning up a skipped device changes nothing the fingerprint
+        # covers, so storage is checked again until every device is used.
+        ch_hookenv.log('Devices not used, not fingerprinting storage: '
+                       '{}'.format(','.join(skipped)))
+        kv.set(STORAGE_FINGERPRINT_KEY, None)
+        return True
+    # The PV UUID links of new PVs are only created once udev processed
+    # their events, without them the next hook would not match.
+    settle_udev()
+    kv.set(STORAGE_FINGERPRINT_KEY,
+           storage_fingerprint(block_devices, settings))
+    return True
+
+
+def _log_new_block_devices(block_devices, kv):
+    '''Log the devices not handled by a previous storage configuration.
+
+    Devices are recorded once storage is configured successfully, so this
+    tells which disks a pattern picked up since, such as hot added ones.
+    '''
+    consumed = kv.get(CONSUMED_DEVICES_KEY)
+    if consumed is None:
+        return
+    new = [device for device in block_devices if device not in consumed]
+    if new:
+        ch_hookenv.log('New block devices: {}'.format(', '.join(new)))
+
+
+def _skip_evacuated_devices(groups, kv):
+    '''Leave out the devices evacuated with the evacuate-device action.
+
+    Evacuated devices are left alone until they are removed from the
+    configuration, at which point they are forgotten.
+
+    :param groups: dict: Devices of each device group.
+    :param kv: Storage of the unit, holding the evacuated devices.
+    :returns: dict: Devices of each device group, minus evacuated ones.
+    '''
+    evacuated = kv.get(EVACUATED_DEVICES_KEY) or []
+    if not evacuated:
+        return groups
+    configured = set()
+    for group, devices in groups.items():
+        kept = []
+        for device in devices:
+            path = _canonical_device(_parse_block_device(device)[0])
+            configured.add(path)
+            if path not in evacuated:
+                kept.append(device)
+        groups[group] = kept
+    remaining = [device for device in evacuated if device in configured]
+    if remaining != evacuated:
+        kv.set(EVACUATED_DEVICES_KEY, remaining)
+    return groups
+
+
+def storage_fingerprint(block_devices, settings):
+    '''Build a fingerprint of the storage state relevant to this charm.
+
+    The fingerprint only relies on the charm configuration, sysfs and the
+    udev maintained LVM PV UUID links, so it can be computed without running
+    any LVM command.
+
+    :param block_devices: list: Block devices as provided in configuration,
+                                without their group.
+    :param settings: dict: JSON serializable storage related settings, such
+                           as the volume groups and the 'overwrite' and
+                           'remove-missing' options.
+    :returns: dict: JSON serializable fingerprint.
+    '''
+    devices = []
+    for block_device in block_devices:
+        (path, size) = _parse_block_device(block_device)
+        if size == 0:
+            size = _block_device_size(path)
+        devices.append([path, size])
+    fingerprint = dict(settings)
+    fingerprint.update({
+        'block-devices': devices,
+        'pv-uuids': _physical_volume_uuids(),
+    })
+    return fingerprint
+
+
+def _block_device_size(block_device):
+    """Return the size of a block device in 512-byte sectors, from sysfs.
+
+    :param block_device: str: Full path of the block device.
+    :returns: int: Size of the device, or None if it does not exist.
+    """
+    name = os.path.basename(_canonical_device(block_device))
+    try:
+        with open('/sys/class/block/{}/size'.format(name)) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def settle_udev():
+    """Wait for udev to process the events queued by the LVM changes."""
+    if subprocess.call(['udevadm', 'settle']) != 0:
+        ch_hookenv.log('udevadm settle timed out', level=ch_hookenv.WARNING)
+
+
+def _physical_volume_uuids():
+    """Return the LVM PVs known to udev, without scanning any device.
+
+    :returns: list: Sorted list of [device, PV UUID] pairs.
+    """
+    try:
+        links = os.listdir(DISK_BY_ID_DIR)
+    except OSError:
+        return []
+    return sorted(
+        [_canonical_device(os.path.join(DISK_BY_ID_DIR, link)),
+         link[len(PV_UUID_LINK_PREFIX):]]
+        for link in links if link.startswith(PV_UUID_LINK_PREFIX))
 
 
 def configure_lvm_storage(block_devices, volume_group, overwrite=False,
-                          remove_missing=False, remove_missing_force=False):
+                          remove_missing=False, remove_missing_force=False,
+                          concurrency=None, thin_pool=None, tuning=None,
+                          cache=None, loopback=None, wipe=None):
     ''' Configure LVM storage on the list of block devices provided
 
     :param block_devices: list: List of allow-listed block devices to detect
@@ -114,56 +662,101 @@ def configure_lvm_storage(block_devices, volume_group, overwrite=False,
     :param remove_missing_force: bool: Remove missing physical volumes from
                            volume group even if logical volumes are allocated
                            on them. Overrides 'remove_missing' if set.
+    :param concurrency: int: Maximum number of block devices to prepare
+                             concurrently. Derived from the number of devices
+                             and CPUs if not set.
+    :param thin_pool: dict: Thin pool options as returned by
+                            get_thin_pool_options(). If set, a thin pool is
+                            created in the volume group when there is none,
+                            and the tunable options of an existing one are
+                            updated.
+    :param tuning: dict: Block device queue settings as returned by
+                         get_block_device_tuning(), applied to every
+                         physical volume of the volume group.
+    :param cache: dict: Cache options as returned by get_cache_options().
+                        The cache devices must also be part of
+                        block_devices; they are added to the volume group
+                        but kept out of the thin pool, and used to cache
+                        the thin pool's data instead.
+    :param loopback: dict: Options of the loopback devices backing
+                           '/path|size' entries, as returned by
+                           get_loopback_options().
+    :param wipe: str: How new devices are wiped, see get_device_wipe().
+                      With 'erase', the erase of the new data devices goes
+                      on in the background and they only get thin pool
+                      data once it completes.
+    :returns: list: Existing devices which were left out of the volume
+                    group, as they are mounted, or hold a partition table
+                    or another volume group and overwrite is not set.
+    :raises DevicePreparationError: if any of the block devices could not be
+                                    prepared. The volume group is still
+                                    configured with the remaining devices.
     '''
-    ch_hookenv.log('LVM info before preparation')
-    log_lvm_info()
-
     ch_hookenv.log('block_devices: {}'.format(','.join(block_devices)))
 
-    devices = []
-    for block_device in block_devices:
-        (block_device, size) = _parse_block_device(block_device)
+    parsed = [_parse_block_device(block_device)
+              for block_device in block_devices]
+    lo_devices = ensure_loopback_devices(
+        [(path, size) for path, size in parsed if size > 0],
+        loopback, concurrency)
+
+    candidates = []
+    for block_device, size in parsed:
+        if size == 0 and is_block_device(block_device):
+            candidates.append(block_device)
+        elif size > 0:
+            candidates.append(lo_devices[block_device])
 
-        if not is_device_mounted(block_device):
-            if size == 0 and is_block_device(block_device):
-                devices.append(block_device)
-            elif size > 0:
-                lo_device = ensure_loopback_device(block_device, str(size))
-                devices.append(lo_device)
+    # Take a single snapshot of the LVM and block device state once all
+    # loopback devices are mapped, and answer every per-device question
+    # from it rather than probing each device individually.
+    inventory = LVMInventory.collect()
+
+    devices = [device for device in candidates
+               if not inventory.is_mounted(device)]
 
     ch_hookenv.log('devices: {}'.format(','.join(devices)))
 
     vg_found = False
-    new_devices = []
+    vg_devices = []
+    to_prepare = []
     for device in devices:
-        if not is_lvm_physical_volume(device):
+        if not inventory.is_physical_volume(device):
             # Unused device
-            if overwrite is True or not has_partition_table(device):
-                prepare_volume(device)
-                new_devices.append(device)
-        elif list_lvm_volume_group(device) != volume_group:
+            if overwrite is True or not inventory.has_partition_table(device):
+                to_prepare.append(device)
+        elif inventory.volume_group(device) != volume_group:
             # Existing LVM but not part of required VG or new device
             if overwrite is True:
-                prepare_volume(device)
-                new_devices.append(device)
+                to_prepare.append(device)
         else:
             # Mark vg as found
             ch_hookenv.log('Found volume-group already created on {}'.format(
                 device))
             vg_found = True
+            vg_devices.append(device)
 
-    ch_hookenv.log('new_devices: {}'.format(','.join(new_devices)))
+    # Thin pools can only exist if the volume group did before this run.
+    thin_pools = inventory.thin_pools(volume_group) if vg_found else []
 
-    ch_hookenv.log('LVM info mid preparation')
-    log_lvm_info()
+    new_devices, failures = prepare_volumes(
+        to_prepare, concurrency, wipe or 'zap',
+        [device for device in to_prepare
+         if inventory.is_physical_volume(device)])
+    prepared = list(new_devices)
+
+    ch_hookenv.log('new_devices: {}'.format(','.join(new_devices)))
+    vg_devices.extend(new_devices)
 
     if not vg_found and new_devices:
         if overwrite:
             ensure_lvm_volume_group_non_existent(volume_group)
 
         # Create new volume group from first device
-        create_lvm_volume_group(volume_group, new_devices[0])
+        with TIMER.step('vgcreate', volume_group):
+            create_lvm_volume_group(volume_group, new_devices[0])
         new_devices.remove(new_devices[0])
+        vg_found = True
 
     # Remove missing physical volumes from volume group
     try:
@@ -178,26 +771,91 @@ def configure_lvm_storage(block_devices, volume_group, overwrite=False,
                        .format(str(e)))
 
     if new_devices:
-        # Extend the volume group as required
-        for new_device in new_devices:
-            extend_lvm_volume_group(volume_group, new_device)
-            thin_pools = list_thin_logical_volume_pools(path_mode=True)
-            if not thin_pools:
-                ch_hookenv.log("No thin pools found")
-            elif len(thin_pools) == 1:
-                ch_hookenv.log("Thin pool {} found, extending with {}".format(
-                    thin_pools[0],
-                    new_device))
-                extend_logical_volume_by_device(thin_pools[0], new_device)
-            else:
-                msg = ("Multiple thin pools ({}) found, skipping auto "
-                       "extending with {}").format(','.join(thin_pools),
-                                                   new_device)
-                ch_hookenv.log(msg)
-    ch_hookenv.log('LVM info after preparation')
-    log_lvm_info()
-
-
+        # Extend the volume group with all the new devices at once rather
+        # than committing metadata once per device.
+        extend_lvm_volume_group(volume_group, new_devices)
+
+    if thin_pool:
+        write_thin_pool_profile(thin_pool)
+
+    # Devices reserved for caching must not hold thin pool data.
+    cache_devices = set()
+    if cache:
+        cache_devices = set(
+            _canonical_device(_parse_block_device(device)[0])
+            for device in cache['devices'])
+
+    if wipe == 'erase':
+        for device in prepared:
+            if _canonical_device(device) not in cache_devices:
+                start_erase(volume_group, device)
+    # Devices being erased are held by their erase LV until it completes.
+    erasing = set(_canonical_device(job['device']) for job in erase_jobs()
+                  if job['volume-group'] == volume_group)
+
+    def _data_devices(devices):
+        return [device for device in devices
+                if _canonical_device(device) not in cache_devices and
+                _canonical_device(device) not in erasing]
+
+    new_data_devices = _data_devices(new_devices)
+    thin_pool_created = False
+    if thin_pool and vg_found and not thin_pools:
+        # Pre-create the pool under the name Cinder expects, so that it is
+        # sized and tuned by the charm rather than by Cinder's defaults.
+        data_devices = _data_devices(vg_devices)
+        options = thin_pool
+        if thin_pool.get('layout'):
+            options = dict(thin_pool, layout=check_lv_layout(
+                thin_pool['layout'], len(data_devices)))
+        if data_devices:
+            create_thin_pool(volume_group, options,
+                             data_devices if cache or erasing else None)
+            thin_pool_created = True
+        else:
+            ch_hookenv.log('Not creating the thin pool of {} until its '
+                           'devices are erased'.format(volume_group))
+    elif new_data_devices:
+        if not thin_pools:
+            ch_hookenv.log("No thin pools found")
+        else:
+            ch_hookenv.log("Thin pools {} found, extending with {}".format(
+                ','.join(pool for pool, _ in thin_pools),
+                ','.join(new_data_devices)))
+            extend_thin_pools(thin_pools, new_data_devices)
+
+    if thin_pool:
+        for pool, _ in thin_pools:
+            tune_thin_pool(pool, thin_pool)
+
+    if cache and vg_found:
+        pool = '{}/{}'.format(volume_group, get_thin_pool_name(volume_group))
+        devices = [device for device in vg_devices
+                   if _canonical_device(device) in cache_devices]
+        if not devices:
+            ch_hookenv.log('No cache device available in {}'.format(
+                volume_group), level=ch_hookenv.WARNING)
+        elif not thin_pool_created and pool not in dict(thin_pools):
+            ch_hookenv.log('Thin pool {} not found, not caching it'.format(
+                pool), level=ch_hookenv.WARNING)
+        elif thin_pool_created or not inventory.is_cached(pool):
+            create_cache(pool, devices, cache,
+                         inventory.has_logical_volume(
+                             volume_group, get_cache_name(volume_group)))
+
+    if tuning is not None:
+        tune_block_devices(
+            [device for device in vg_devices if is_block_device(device)],
+            tuning, volume_group)
+
+    log_lvm_info(inventory)
+
+    if failures:
+        raise DevicePreparationError(failures)
+    return [device for device in candidates if device not in vg_devices]
+
+
+@timed('vgreduce')
 def reduce_lvm_volume_group_missing(volume_group, extra_args=None):
     '''
     Remove all missing physical volumes from the volume group, if there
@@ -213,16 +871,56 @@ def reduce_lvm_volume_group_missing(volume_group, extra_args=None):
     subprocess.check_call(command)
 
 
-def extend_lvm_volume_group(volume_group, block_device):
+@timed('vgextend')
+def extend_lvm_volume_group(volume_group, block_devices):
     '''
-    Extend an LVM volume group onto a given block device.
+    Extend an LVM volume group onto the given block devices.
 
-    Assumes block device has already been initialized as an LVM PV.
+    Assumes block devices have already been initialized as LVM PVs.
 
-    :param volume_group: str: Name of volume group to create.
-    :block_device: str: Full path of PV-initialized block device.
+    :param volume_group: str: Name of volume group to extend.
+    :param block_devices: list: Full paths of PV-initialized block devices,
+                                or a single path.
     '''
-    subprocess.check_call(['vgextend', volume_group, block_device])
+    if isinstance(block_devices, str):
+        block_devices = [block_devices]
+    subprocess.check_call(['vgextend', volume_group] + list(block_devices))
+
+
+@timed('lvextend')
+def extend_logical_volume_by_devices(lv_name, block_devices):
+    '''
+    Extend a logical volume by the free space on the given physical volumes.
+
+    :param lv_name: str: Name of logical volume to extend (vg/lv format).
+    :param block_devices: list: Full paths of the PVs to allocate from.
+    '''
+    subprocess.check_call(['lvextend', lv_name] + list(block_devices))
+
+
+@timed('extend-thin-pools')
+def extend_thin_pools(thin_pools, block_devices):
+    '''
+    Extend thin pools over new physical volumes, sharing the new space
+    proportionally to the current size of each pool.
+
+    :param thin_pools: list: (pool, size) tuples, pool in vg/lv format.
+    :param block_devices: list: Full paths of the PVs to allocate from.
+    '''
+    remaining = sum(size for _, size in thin_pools)
+    for pool, size in thin_pools[:-1]:
+        # %PVS is relative to the space still free on the PVs, so each pool
+        # gets its share of what the previous pools left.
+        if remaining:
+            percent = int(100 * size / remaining)
+        else:
+            percent = int(100 / len(thin_pools))
+        remaining -= size
+        if percent:
+            subprocess.check_call(['lvextend', '--extents',
+                                   '+{}%PVS'.format(percent), pool] +
+                                  list(block_devices))
+    extend_logical_volume_by_devices(thin_pools[-1][0], block_devices)
 
 
 def lvm_volume_group_exists(volume_group):
@@ -257,36 +955,1268 @@ def ensure_lvm_volume_group_non_existent(volume_group):
     remove_lvm_volume_group(volume_group)
 
 
-def log_lvm_info():
-    """Log some useful information about how LVM is setup."""
+def get_thin_pool_name(volume_group):
+    """Return the name of the thin pool Cinder uses in a volume group.
+
+    :param volume_group: str: Name of volume group.
+    """
+    return '{}-pool'.format(volume_group)
+
+
+def get_thin_pool_options():
+    """Return the thin pool options from the charm configuration.
+
+    :returns: dict: Thin pool options, or None if logical volumes are not
+                    thin provisioned.
+    :raises ValueError: if any of the options is invalid.
+    """
+    if ch_hookenv.config('allocation-type') not in THIN_ALLOCATION_TYPES:
+        return None
+
+    size = ch_hookenv.config('thin-pool-size') or DEFAULT_THIN_POOL_SIZE
+    if size.endswith('%'):
+        percent = size[:-1]
+        if not percent.isdigit() or not 0 < int(percent) <= 100:
+            raise ValueError("Invalid thin-pool-size '{}'".format(size))
+    else:
+        _validate_lvm_size('thin-pool-size', size)
+
+    options = {
+        'size': size,
+        'chunk-size': ch_hookenv.config('thin-pool-chunk-size') or None,
+        'metadata-size': (ch_hookenv.config('thin-pool-metadata-size') or
+                          None),
+        'zero': ch_hookenv.config('thin-pool-zero') is not False,
+        'discards': ch_hookenv.config('thin-pool-discards') or None,
+        'autoextend-threshold': _config_int(
+            'thin-pool-autoextend-threshold',
+            DEFAULT_THIN_POOL_AUTOEXTEND_THRESHOLD),
+        'autoextend-percent': _config_int(
+            'thin-pool-autoextend-percent',
+            DEFAULT_THIN_POOL_AUTOEXTEND_PERCENT),
+        'layout': get_lv_layout_options(),
+    }
+    for option in ('chunk-size', 'metadata-size'):
+        if options[option]:
+            _validate_lvm_size('thin-pool-' + option, options[option])
+    if options['discards'] and options['discards'] not in THIN_POOL_DISCARDS:
+        raise ValueError("Invalid thin-pool-discards '{}', must be one of: "
+                         "{}".format(options['discards'],
+                                     ', '.join(THIN_POOL_DISCARDS)))
+    if not 50 <= options['autoextend-threshold'] <= 100:
+        raise ValueError("Invalid thin-pool-autoextend-threshold '{}', must "
+                         "be between 50 and 100".format(
+                             options['autoextend-threshold']))
+    if options['autoextend-percent'] < 1:
+        raise ValueError("Invalid thin-pool-autoextend-percent '{}', must "
+                         "be positive".format(options['autoextend-percent']))
+    return options
+
+
+def get_lv_layout_options():
+    """Return the logical volume layout options from the charm configuration.
+
+    With thin provisioning the layout applies to the thin pool, and so to
+    every volume Cinder creates in it. With thick provisioning only 'raid1'
+    is available, through Cinder's own mirroring of the volumes.
+
+    :returns: dict: Layout options, or None for the default linear layout.
+    :raises ValueError: if any of the options is invalid.
+    """
+    layout = ch_hookenv.config('lv-layout') or 'linear'
+    if layout not in LV_LAYOUTS:
+        raise ValueError("Invalid lv-layout '{}', must be one of: "
+                         "{}".format(layout, ', '.join(LV_LAYOUTS)))
+    if layout == 'linear':
+        return None
+    if (ch_hookenv.config('allocation-type') not in THIN_ALLOCATION_TYPES and
+            layout != 'raid1'):
+        raise ValueError("lv-layout '{}' requires allocation-type 'thin' or "
+                         "'auto'".format(layout))
+
+    options = {
+        'type': layout,
+        'stripes': _config_int('lv-stripes', 0),
+        'stripe-size': ch_hookenv.config('lv-stripe-size') or None,
+        'mirrors': _config_int('lv-mirrors', 1),
+    }
+    if options['stripes'] and options['stripes'] < 2:
+        raise ValueError("Invalid lv-stripes '{}', must be 0 or at least "
+                         "2".format(options['stripes']))
+    if options['stripe-size']:
+        _validate_lvm_size('lv-stripe-size', options['stripe-size'])
+    if options['mirrors'] < 1:
+        raise ValueError("Invalid lv-mirrors '{}', must be "
+                         "positive".format(options['mirrors']))
+    return options
+
+
+def check_lv_layout(layout, pv_count):
+    """Check that a layout can be allocated from a number of PVs.
+
+    :param layout: dict: Layout options from get_lv_layout_options().
+    :param pv_count: int: Number of data PVs in the volume group.
+    :returns: dict: The layout, with the number of stripes resolved.
+    :raises ValueError: if there are not enough PVs for the layout.
+    """
+    layout = dict(layout)
+    images = layout['mirrors'] + 1
+    if layout['type'] == 'striped':
+        layout['stripes'] = layout['stripes'] or pv_count
+        needed = max(layout['stripes'], 2)
+    elif layout['type'] == 'raid10':
+        layout['stripes'] = layout['stripes'] or pv_count // images
+        needed = max(layout['stripes'], 2) * images
+    else:
+        needed = images
+    if pv_count < needed:
+        raise ValueError("lv-layout '{}' needs {} physical volumes, {} "
+                         "available".format(layout['type'], needed,
+                                            pv_count))
+    return layout
+
+
+def _lv_layout_args(layout):
+    if not layout:
+        return []
+    args = []
+    if layout['type'] in RAID_LAYOUTS:
+        args.extend(['--type', layout['type'],
+                     '--mirrors', str(layout['mirrors'])])
+    if layout['type'] in ('striped', 'raid10'):
+        args.extend(['--stripes', str(layout['stripes'])])
+        if layout.get('stripe-size'):
+            args.extend(['--stripesize', layout['stripe-size']])
+    return args
+
+
+def _config_int(option, default):
+    value = ch_hookenv.config(option)
+    return default if value is None else value
+
+
+def get_capacity_options():
+    """Return the backend capacity options from the charm configuration.
+
+    :returns: list: (option, value) tuples for the backend configuration.
+    :raises ValueError: if any of the options is invalid.
+    """
+    options = []
+    ratio = ch_hookenv.config('max-over-subscription-ratio')
+    if ratio:
+        ratio = str(ratio)
+        try:
+            valid = ratio == 'auto' or float(ratio) >= 1.0
+        except ValueError:
+            valid = False
+        if not valid:
+            raise ValueError("Invalid max-over-subscription-ratio '{}', "
+                             "must be 'auto' or a number not lower than "
+                             "1.0".format(ratio))
+        options.append(('max_over_subscription_ratio', ratio))
+
+    reserved = ch_hookenv.config('reserved-percentage')
+    if reserved is not None:
+        if not 0 <= reserved <= 100:
+            raise ValueError("Invalid reserved-percentage '{}', must be "
+                             "between 0 and 100".format(reserved))
+        options.append(('reserved_percentage', reserved))
+    return options
+
+
+def get_image_volume_cache_options():
+    """Return the image-volume cache options from the charm configuration.
+
+    :returns: dict: Cache options, with the 'max-size' either in GB or as a
+                    percentage of the volume group size (ex. '10%'), or
+                    None if the cache is disabled.
+    :raises ValueError: if any of the options is invalid.
+    """
+    if not ch_hookenv.config('image-volume-cache'):
+        return None
+    options = {
+        'max-size': str(ch_hookenv.config('image-volume-cache-max-size') or
+                        DEFAULT_IMAGE_CACHE_SIZE),
+        'max-count': _config_int('image-volume-cache-max-count', 0),
+    }
+    match = IMAGE_CACHE_SIZE_RE.match(options['max-size'])
+    if not match or (match.group(2) and not
+                     0 < int(match.group(1)) <= 100):
+        raise ValueError("Invalid image-volume-cache-max-size '{}', must be "
+                         "a number of GB or a percentage of the volume "
+                         "group size".format(options['max-size']))
+    if options['max-count'] < 0:
+        raise ValueError("Invalid image-volume-cache-max-count '{}', must "
+                         "not be negative".format(options['max-count']))
+    return options
+
+
+def image_volume_cache_config(volume_group, options):
+    """Return the backend configuration of the image-volume cache.
+
+    A percentage 'max-size' is resolved against the size of the volume
+    group when storage was last configured. With thick volumes, where the
+    cached images take space from the volume group, it is also limited to
+    half of its free space at that time. The limit is left out, hence
+    unlimited, if the volume group does not exist yet.
+
+    :param volume_group: str: Name of the volume group of the backend.
+    :param options: dict: Cache options, see get_image_volume_cache_options.
+    :returns: list: (option, value) tuples for the backend configuration.
+    """
+    if not options:
+        return []
+    config = [('image_volume_cache_enabled', True)]
+    size, percent = IMAGE_CACHE_SIZE_RE.match(options['max-size']).groups()
+    if not percent:
+        config.append(('image_volume_cache_max_size_gb', int(size)))
+    else:
+        vg = _volume_group_sizes().get(volume_group)
+        if vg:
+            vg_size, vg_free = vg
+            max_size = vg_size * int(size) // 100
+            if not get_thin_pool_options():
+                max_size = min(max_size, vg_free // 2)
+            config.append(('image_volume_cache_max_size_gb',
+                           max(1, int(max_size // (1 << 30)))))
+    if options['max-count']:
+        config.append(('image_volume_cache_max_count',
+                       options['max-count']))
+    return config
+
+
+def _volume_group_sizes():
+    """Return the size and free space of the volume groups, in bytes.
+
+    These are saved and only read again once storage was reconfigured, as
+    the configuration derived from them is sent to the principal, which
+    restarts cinder-volume whenever it changes.
+
+    :returns: dict: [size, free] of each volume group, by name.
+    """
+    kv = unitdata.kv()
+    sizes = kv.get(VOLUME_GROUP_SIZES_KEY)
+    if sizes is None:
+        sizes = {vg['vg_name']: [_to_number(vg.get('vg_size')) or 0,
+                                 _to_number(vg.get('vg_free')) or 0]
+                 for vg in LVMInventory.collect(devices=False).vgs}
+        kv.set(VOLUME_GROUP_SIZES_KEY, sizes)
+    return sizes
+
+
+def get_volume_copy_options():
+    """Return the volume copy options from the charm configuration.
+
+    :returns: dict: Volume copy options, with the 'bps-limit' in bytes per
+                    second, 0 if copies are not throttled.
+    :raises ValueError: if any of the options is invalid, or if throttling
+                        is requested on a host without the cgroup v1 blkio
+                        controller Cinder relies on.
+    """
+    options = {
+        'block-size': ch_hookenv.config('volume-copy-block-size') or None,
+        'bps-limit': ch_hookenv.config('volume-copy-bps-limit') or '0',
+        'cgroup': (ch_hookenv.config('volume-copy-cgroup') or
+                   DEFAULT_COPY_CGROUP),
+    }
+    if (options['block-size'] and
+            not DD_BLOCKSIZE_RE.match(options['block-size'])):
+        raise ValueError("Invalid volume-copy-block-size '{}', must be a "
+                         "number of bytes, optionally followed by K, M or "
+                         "G".format(options['block-size']))
     try:
-        pvscan_output = subprocess.check_output(['pvscan']).decode('UTF-8')
-        ch_hookenv.log('pvscan:\n{}'.format(pvscan_output))
-    except subprocess.CalledProcessError:
-        ch_hookenv.log('pvscan did not complete successfully; may not be '
-                       'setup yet')
+        options['bps-limit'] = int(bytes_from_string(
+            str(options['bps-limit'])))
+    except ValueError:
+        raise ValueError("Invalid volume-copy-bps-limit '{}', must be a "
+                         "number of bytes per second, optionally followed "
+                         "by K, M or G".format(options['bps-limit']))
+    if not CGROUP_NAME_RE.match(options['cgroup']):
+        raise ValueError("Invalid volume-copy-cgroup '{}', must only contain "
+                         "letters, digits, dots, dashes and "
+                         "underscores".format(options['cgroup']))
+    if options['bps-limit'] and not os.path.isdir(BLKIO_CGROUP_DIR):
+        raise ValueError("volume-copy-bps-limit requires the cgroup v1 blkio "
+                         "controller, which is not mounted on this host")
+    return options
+
+
+def volume_copy_config(devices, options):
+    """Return the backend configuration of the volume copies.
+
+    Unless set, the dd block size is raised to SOLID_STATE_DD_BLOCKSIZE
+    when every device of the backend is solid state, and left to Cinder's
+    default otherwise.
+
+    :param devices: list: Configured devices of the backend.
+    :param options: dict: Volume copy options, see get_volume_copy_options.
+    :returns: list: (option, value) tuples for the backend configuration.
+    """
+    config = []
+    block_size = options['block-size']
+    if not block_size and devices and not any(
+            _is_rotational(device) for device in devices):
+        block_size = SOLID_STATE_DD_BLOCKSIZE
+    if block_size:
+        config.append(('volume_dd_blocksize', block_size))
+    if options['bps-limit']:
+        config.append(('volume_copy_bps_limit', options['bps-limit']))
+        config.append(('volume_copy_blkio_cgroup_name', options['cgroup']))
+    return config
+
+
+def _is_rotational(device):
+    """Determine whether a configured device is rotational.
+
+    The 'device-rotational' option takes precedence over sysfs. Loopback
+    devices, and devices which can not be checked, count as rotational.
+    """
+    (path, size) = _parse_block_device(device)
+    if size:
+        return True
+    rotational = get_block_device_tuning().get('rotational')
+    if rotational is None:
+        try:
+            with open(os.path.join(_sysfs_queue_dir(path), 'rotational')) as f:
+                rotational = f.read().strip()
+        except IOError:
+            return True
+    return rotational != '0'
+
+
+def configure_volume_copy_cgroup(options):
+    """Prepare the blkio cgroup Cinder throttles volume copies with.
+
+    Cinder creates and configures the cgroup with the cgroup-tools commands
+    before each copy, so these are installed when the limit is set or
+    changed, and the cgroup is created upfront to check the blkio controller
+    can be used.
+
+    :param options: dict: Volume copy options, see get_volume_copy_options.
+    """
+    kv = unitdata.kv()
+    if not options['bps-limit']:
+        kv.set(VOLUME_COPY_LIMIT_KEY, None)
+        return
+    if kv.get(VOLUME_COPY_LIMIT_KEY) != options['bps-limit']:
+        missing = filter_installed_packages(['cgroup-tools'])
+        if missing:
+            apt_install(missing, fatal=True)
+        kv.set(VOLUME_COPY_LIMIT_KEY, options['bps-limit'])
+    os.makedirs(os.path.join(BLKIO_CGROUP_DIR, options['cgroup']),
+                exist_ok=True)
+
+
+def get_target_options(protocols, helpers, default_helper):
+    """Return the volume target options from the charm configuration.
+
+    The options are checked against the target helper in effect: the
+    configured one, else the one recorded in the leader settings for the
+    deployment, else the default helper of the release.
+
+    :param protocols: tuple: Target protocols supported by the release.
+    :param helpers: tuple: Target helpers supported by the release.
+    :param default_helper: str: Target helper Cinder uses by default.
+    :returns: list: (option, value) tuples for the backend configuration.
+    :raises ValueError: if any of the options is invalid, or if they do not
+                        apply to the selected target helper and protocol.
+    """
+    options = []
+    helper = ch_hookenv.config('target-helper')
+    if helper:
+        if helper not in helpers:
+            raise ValueError("Invalid target-helper '{}', must be one of: "
+                             "{}".format(helper, ', '.join(helpers)))
+        options.append(('target_helper', helper))
+    else:
+        helper = ch_hookenv.leader_get('target-helper') or default_helper
+
+    protocol = ch_hookenv.config('target-protocol')
+    if protocol:
+        if protocol not in protocols:
+            raise ValueError("Invalid target-protocol '{}', must be one of: "
+                             "{}".format(protocol, ', '.join(protocols)))
+        options.append(('target_protocol', protocol))
+    nvmet = helper in NVMET_TARGET_HELPERS
+    if nvmet != (protocol in NVMET_TARGET_PROTOCOLS):
+        raise ValueError("target-helper '{}' does not support "
+                         "target-protocol '{}'".format(
+                             helper, protocol or 'iscsi'))
+
+    addresses = (ch_hookenv.config('target-secondary-ip-addresses') or
+                 '').split()
+    for address in addresses:
+        try:
+            ipaddress.ip_address(address)
+        except ValueError:
+            raise ValueError("Invalid target-secondary-ip-addresses entry "
+                             "'{}'".format(address))
+    if addresses:
+        options.append(('target_secondary_ip_addresses',
+                        ','.join(addresses)))
+
+    # Only tgtadm makes use of the I/O type and write cache settings.
+    for option, values in (('iscsi-iotype', ISCSI_IOTYPES),
+                           ('iscsi-write-cache', ('on', 'off'))):
+        value = ch_hookenv.config(option)
+        if not value:
+            continue
+        if value not in values:
+            raise ValueError("Invalid {} '{}', must be one of: {}".format(
+                option, value, ', '.join(values)))
+        if helper != 'tgtadm':
+            raise ValueError("{} requires target-helper "
+                             "'tgtadm'".format(option))
+        options.append((option.replace('-', '_'), value))
+    return options
+
+
+def _validate_lvm_size(option, size):
+    if not LVM_SIZE_RE.match(size):
+        raise ValueError("Invalid {} '{}', must be a number followed by a "
+                         "unit (K, M, G, T or P)".format(option, size))
+
+
+@timed('create-thin-pool')
+def create_thin_pool(volume_group, options, block_devices=None):
+    """Create the thin pool used by Cinder in a volume group.
+
+    A striped pool is created in one go. LVM cannot create a RAID thin pool
+    directly, so its data and metadata are created as RAID volumes first and
+    then converted into a pool.
+
+    :param volume_group: str: Name of volume group.
+    :param options: dict: Thin pool options from get_thin_pool_options(),
+                          with the number of stripes of the layout resolved
+                          by check_lv_layout().
+    :param block_devices: list: PVs to allocate the pool from, in which case
+                                percentage sizes are relative to their free
+                                space. Defaults to the whole volume group.
+    """
+    pool = get_thin_pool_name(volume_group)
+    layout = options.get('layout')
+    size = options['size']
+    if size.endswith('%'):
+        size_args = ['--extents', '{}{}'.format(
+            size, 'PVS' if block_devices else 'FREE')]
+    else:
+        size_args = ['--size', size]
+    raid = layout and layout['type'] in RAID_LAYOUTS
+    pool_args = []
+    if options.get('chunk-size'):
+        pool_args.extend(['--chunksize', options['chunk-size']])
+    if options.get('metadata-size') and not raid:
+        pool_args.extend(['--poolmetadatasize', options['metadata-size']])
+    pool_args.extend(['--zero', 'y' if options.get('zero', True) else 'n'])
+    if options.get('discards'):
+        pool_args.extend(['--discards', options['discards']])
+
+    if raid:
+        metadata = '{}-meta'.format(pool)
+        commands = [
+            # The metadata goes first, so that the data can take a
+            # percentage of the remaining free space.
+            ['lvcreate', '--yes', '--type', 'raid1',
+             '--mirrors', str(layout['mirrors']),
+             '--size', (options.get('metadata-size') or
+                        DEFAULT_RAID_POOL_METADATA_SIZE),
+             '--name', metadata, volume_group] + (block_devices or []),
+            ['lvcreate', '--yes'] + _lv_layout_args(layout) + size_args +
+            ['--name', pool, volume_group] + (block_devices or []),
+            ['lvconvert', '--yes', '--type', 'thin-pool',
+             '--poolmetadata', '{}/{}'.format(volume_group, metadata),
+             '--metadataprofile', THIN_POOL_PROFILE] + pool_args +
+            ['{}/{}'.format(volume_group, pool)],
+        ]
+    else:
+        cmd = (['lvcreate', '--yes', '--type', 'thin-pool',
+                '--metadataprofile', THIN_POOL_PROFILE] + size_args +
+               _lv_layout_args(layout) + pool_args +
+               ['--name', pool, volume_group])
+        commands = [cmd + (block_devices or [])]
+    for cmd in commands:
+        ch_hookenv.log('Creating thin pool: {}'.format(' '.join(cmd)))
+        subprocess.check_call(cmd)
+
+
+def get_cache_name(volume_group):
+    """Return the name of the cache LV of a volume group.
+
+    :param volume_group: str: Name of volume group.
+    """
+    return '{}-cache'.format(volume_group)
+
+
+def get_cache_options():
+    """Return the cache tier options from the charm configuration.
+
+    :returns: dict: Cache options, or None if no cache device is configured.
+    :raises ValueError: if any of the options is invalid, or if logical
+                        volumes are not thin provisioned, as only the thin
+                        pool can be cached.
+    """
+    devices = ch_hookenv.config('cache-device')
+    if devices in [None, 'None', 'none', '']:
+        return None
+    if ch_hookenv.config('allocation-type') not in THIN_ALLOCATION_TYPES:
+        raise ValueError("cache-device requires allocation-type 'thin' or "
+                         "'auto'")
+
+    options = {
+        'devices': devices.split(),
+        'mode': ch_hookenv.config('cache-mode') or DEFAULT_CACHE_MODE,
+        'chunk-size': ch_hookenv.config('cache-chunk-size') or None,
+    }
+    for device in options['devices']:
+        if _parse_block_device(_split_device_group(device)[1])[1]:
+            raise ValueError("Invalid cache-device '{}', must be a block "
+                             "device".format(device))
+    if options['mode'] not in CACHE_MODES:
+        raise ValueError("Invalid cache-mode '{}', must be one of: "
+                         "{}".format(options['mode'], ', '.join(CACHE_MODES)))
+    if options['chunk-size']:
+        _validate_lvm_size('cache-chunk-size', options['chunk-size'])
+    return options
+
+
+@timed('create-cache')
+def create_cache(pool, block_devices, options, exists=False):
+    """Cache the data of a thin pool on fast devices.
+
+    With the 'writecache' mode a dm-writecache volume is used, otherwise a
+    dm-cache pool in the given mode.
+
+    :param pool: str: Thin pool to cache, in vg/lv format.
+    :param block_devices: list: Full paths of the PVs to hold the cache.
+    :param options: dict: Cache options from get_cache_options().
+    :param exists: bool: Whether the cache LV was already created, in which
+                         case it is only attached to the pool.
+    """
+    volume_group = pool.split('/')[0]
+    cache = get_cache_name(volume_group)
+    writecache = options['mode'] == 'writecache'
+    if not exists:
+        cmd = ['lvcreate', '--yes']
+        if not writecache:
+            cmd.extend(['--type', 'cache-pool'])
+            if options.get('chunk-size'):
+                cmd.extend(['--chunksize', options['chunk-size']])
+        cmd.extend(['--extents', CACHE_EXTENTS, '--name', cache,
+                    volume_group] + list(block_devices))
+        ch_hookenv.log('Creating cache: {}'.format(' '.join(cmd)))
+        subprocess.check_call(cmd)
+
+    cache = '{}/{}'.format(volume_group, cache)
+    if writecache:
+        cmd = ['lvconvert', '--yes', '--type', 'writecache',
+               '--cachevol', cache, pool]
+    else:
+        cmd = ['lvconvert', '--yes', '--type', 'cache', '--cachepool', cache,
+               '--cachemode', options['mode'], pool]
+    ch_hookenv.log('Attaching cache: {}'.format(' '.join(cmd)))
+    subprocess.check_call(cmd)
+
+
+def write_thin_pool_profile(options):
+    """Write the LVM profile attached to the thin pools managed by the charm.
+
+    The profile holds the autoextend settings, which dmeventd applies when
+    the data or metadata usage of a pool crosses the threshold.
 
+    :param options: dict: Thin pool options from get_thin_pool_options().
+    """
+    write_file(THIN_POOL_PROFILE_PATH, THIN_POOL_PROFILE_TEMPLATE.format(
+        threshold=options['autoextend-threshold'],
+        percent=options['autoextend-percent']))
+
+
+@timed('tune-thin-pool')
+def tune_thin_pool(pool, options):
+    """Apply the tunable thin pool options to an existing pool.
+
+    The chunk size of a pool cannot be changed once created, and its
+    metadata can only grow, so the metadata is only extended when the
+    configured size is larger than the current one.
+
+    :param pool: str: Thin pool in vg/lv format.
+    :param options: dict: Thin pool options from get_thin_pool_options().
+    """
+    cmd = ['lvchange', '--metadataprofile', THIN_POOL_PROFILE,
+           '--zero', 'y' if options.get('zero', True) else 'n']
+    if options.get('discards'):
+        cmd.extend(['--discards', options['discards']])
+    subprocess.check_call(cmd + [pool])
+
+    if options.get('metadata-size'):
+        wanted = bytes_from_string(options['metadata-size'].upper())
+        current = _lvm_report('lvs', 'lv', ['lv_metadata_size'],
+                              args=[pool])
+        if current and wanted > _to_number(
+                current[0].get('lv_metadata_size')):
+            ch_hookenv.log('Extending metadata of thin pool {} to {}'.format(
+                pool, options['metadata-size']))
+            subprocess.check_call(['lvextend', '--poolmetadatasize',
+                                   options['metadata-size'], pool])
+
+
+def get_volume_clear_options():
+    """Return the volume wipe options from the charm configuration.
+
+    The 'discard' method makes Cinder skip clearing volumes and has LVM
+    discard the extents of removed volumes instead, which is only safe if
+    every configured block device supports discard.
+
+    :returns: list: (option, value) tuples for the backend configuration.
+    :raises ValueError: if the wipe method is invalid, or if 'discard' is
+                        selected but not supported by all block devices.
+    """
+    method = ch_hookenv.config('volume-clear') or 'zero'
+    if method not in VOLUME_CLEAR_METHODS:
+        raise ValueError("Invalid volume-clear '{}', must be one of: "
+                         "{}".format(method, ', '.join(VOLUME_CLEAR_METHODS)))
+    if method == 'discard':
+        unsupported = [device for device in _configured_block_devices()
+                       if not supports_discard(device)]
+        if unsupported:
+            raise ValueError("volume-clear 'discard' is not supported by: "
+                             "{}".format(', '.join(unsupported)))
+
+    options = [
+        ('volume_clear', 'none' if method == 'discard' else method),
+        ('volume_clear_size', ch_hookenv.config('erase-size')),
+    ]
+    ionice = ch_hookenv.config('volume-clear-ionice')
+    if ionice and method == 'zero':
+        options.append(('volume_clear_ionice', ionice))
+    return options
+
+
+def _configured_block_devices():
+    """Return the full paths of the configured block devices.
+
+    Loopback backing files are left out, as they are not block devices.
+    """
+    devices = []
+    for group_devices in get_device_groups().values():
+        for device in group_devices:
+            (path, size) = _parse_block_device(device)
+            if size == 0:
+                devices.append(path)
+    return devices
+
+
+def supports_discard(block_device):
+    """Determine whether a block device supports discard, from sysfs.
+
+    :param block_device: str: Full path of the block device.
+    :returns: bool: True if the device accepts discard requests.
+    """
+    queue = _sysfs_queue_dir(block_device)
     try:
-        vgscan_output = subprocess.check_output(['vgscan']).decode('UTF-8')
-        ch_hookenv.log('vgscan:\n{}'.format(vgscan_output))
-    except subprocess.CalledProcessError:
-        ch_hookenv.log('vgscan did not complete successfully')
+        with open(os.path.join(queue, 'discard_max_bytes')) as f:
+            return int(f.read().strip()) > 0
+    except (IOError, ValueError):
+        return False
+
 
+def _sysfs_queue_dir(block_device):
+    """Return the sysfs request queue directory of a block device.
+
+    Partitions share the request queue of their parent device, in which
+    case the queue of the parent is returned.
+    """
+    sysfs = os.path.realpath('/sys/class/block/{}'.format(
+        os.path.basename(_canonical_device(block_device))))
+    if not os.path.isdir(os.path.join(sysfs, 'queue')):
+        sysfs = os.path.dirname(sysfs)
+    return os.path.join(sysfs, 'queue')
 
-def prepare_volume(device):
+
+def get_block_device_tuning():
+    """Return the block device queue settings from the charm configuration.
+
+    :returns: dict: Mapping of sysfs queue attributes to their values, empty
+                    if no tuning is configured.
+    :raises ValueError: if any of the options is invalid.
+    """
+    tuning = {}
+    scheduler = ch_hookenv.config('io-scheduler')
+    if scheduler:
+        tuning['scheduler'] = scheduler
+    rotational = ch_hookenv.config('device-rotational')
+    if rotational:
+        if rotational not in ('true', 'false'):
+            raise ValueError("Invalid device-rotational '{}', must be 'true' "
+                             "or 'false'".format(rotational))
+        tuning['rotational'] = '1' if rotational == 'true' else '0'
+    for option, attribute, minimum in (('read-ahead-kb', 'read_ahead_kb', 0),
+                                       ('nr-requests', 'nr_requests', 1)):
+        value = ch_hookenv.config(option)
+        if value is None:
+            continue
+        if value < minimum:
+            raise ValueError("Invalid {} '{}', must be at least {}".format(
+                option, value, minimum))
+        tuning[attribute] = str(value)
+    return tuning
+
+
+@timed('tune-block-devices')
+def tune_block_devices(block_devices, tuning, volume_group):
+    """Apply queue settings to block devices and persist them in udev rules.
+
+    The settings are written to sysfs right away, and a udev rule per device
+    reapplies them whenever the device appears, matching the device by a
+    stable /dev/disk/by-id link when there is one. There is one rules file
+    per volume group, removed when no tuning is configured.
+
+    :param block_devices: list: Full paths of the block devices to tune.
+    :param tuning: dict: Settings from get_block_device_tuning().
+    :param volume_group: str: Name of the volume group of the devices.
+    """
+    rules_file = UDEV_TUNING_RULES.format(volume_group)
+    if not tuning:
+        if os.path.exists(rules_file):
+            ch_hookenv.log('Removing {}'.format(rules_file))
+            os.remove(rules_file)
+        return
+
+    links = _stable_device_links()
+    rules = ['# Managed by the cinder-lvm charm.']
+    for block_device in block_devices:
+        queue = _sysfs_queue_dir(block_device)
+        for attribute in QUEUE_ATTRIBUTES:
+            if attribute not in tuning:
+                continue
+            try:
+                with open(os.path.join(queue, attribute), 'w') as f:
+                    f.write(tuning[attribute])
+            except (IOError, OSError) as e:
+                ch_hookenv.log('Unable to set {} of {} to {}: {}'.format(
+                    attribute, block_device, tuning[attribute], e),
+                    level=ch_hookenv.WARNING)
+
+        disk = os.path.basename(os.path.dirname(queue))
+        link = links.get('/dev/{}'.format(disk))
+        if link:
+            # DEVLINKS is a space separated list of all the device links.
+            match = 'ENV{{DEVLINKS}}=="*{0}|*{0} *"'.format(link)
+        else:
+            match = 'KERNEL=="{}"'.format(disk)
+        rules.append(', '.join(
+            ['ACTION=="add|change"', 'SUBSYSTEM=="block"',
+             'ENV{DEVTYPE}=="disk"', match] +
+            ['ATTR{{queue/{}}}="{}"'.format(attribute, tuning[attribute])
+             for attribute in QUEUE_ATTRIBUTES if attribute in tuning]))
+
+    content = '\n'.join(rules) + '\n'
+    try:
+        with open(rules_file) as f:
+            current = f.read()
+    except IOError:
+        current = None
+    if content != current:
+        ch_hookenv.log('Updating {}'.format(rules_file))
+        write_file(rules_file, content)
+
+
+@ch_hookenv.cached
+def _disk_id_links():
+    """Scan the /dev/disk/by-id links of whole disks.
+
+    Partition and LVM links are ignored. The scan is done once per hook.
+
+    :returns: list: (name, device) tuples, with the kernel device path each
+                    link points to.
+    """
+    try:
+        names = os.listdir(DISK_BY_ID_DIR)
+    except OSError:
+        return []
+    return [(name, _canonical_device(os.path.join(DISK_BY_ID_DIR, name)))
+            for name in sorted(names)
+            if '-part' not in name and not name.startswith(('lvm-', 'dm-'))]
+
+
+def _stable_device_links():
+    """Map whole disk device paths to a stable /dev/disk/by-id link.
+
+    WWN based links are preferred.
+
+    :returns: dict: Mapping of kernel device paths to by-id link paths.
+    """
+    links = {}
+    for name, path in sorted(_disk_id_links(),
+                             key=lambda link: (not link[0].startswith('wwn-'),
+                                               link[0])):
+        links.setdefault(path, os.path.join(DISK_BY_ID_DIR, name))
+    return links
+
+
+def get_lvm_local_config(refresh_filter=True):
+    """Return the LVM settings the charm manages in lvmlocal.conf.
+
+    :param refresh_filter: bool: Whether to compute the device filter again,
+                                 which takes an LVM inventory, rather than
+                                 reuse the last one computed. The saved
+                                 filter is dropped while the filter is
+                                 disabled, as devices may change meanwhile.
+    :returns: dict: Mapping of LVM configuration sections to their settings.
+    """
+    config = {}
+    if ch_hookenv.config('volume-clear') == 'discard':
+        config.setdefault('devices', {})['issue_discards'] = 1
+    kv = unitdata.kv()
+    if not ch_hookenv.config('lvm-device-filter'):
+        kv.set(LVM_DEVICE_FILTER_KEY, None)
+    else:
+        device_filter = (None if refresh_filter
+                         else kv.get(LVM_DEVICE_FILTER_KEY))
+        if device_filter is None:
+            device_filter = get_lvm_device_filter()
+            kv.set(LVM_DEVICE_FILTER_KEY, device_filter)
+        config.setdefault('devices', {})['global_filter'] = device_filter
+    return config
+
+
+def get_lvm_device_filter():
+    """Return a global_filter accepting only the PVs LVM needs to scan.
+
+    The configured block and cache devices are accepted, so that they can be
+    initialized, as well as the current PVs of the charm's volume groups and
+    the PVs of the other volume groups of the host, so that these keep
+    working. PVs nested in logical volumes, like the ones of guests in
+    Cinder volumes, and PVs on iSCSI attached disks are left out.
+
+    :returns: list: LVM filter patterns, ending with the rejection of any
+                    other device.
+    """
+    groups = get_device_groups()
+    cache = get_cache_options()
+    cache_groups = get_device_groups(
+        ' '.join(cache['devices']) if cache else '')
+    volume_groups = set(get_volume_group_name(group)
+                        for group in list(groups) + list(cache_groups))
+    devices = _configured_block_devices()
+    for group_devices in cache_groups.values():
+        devices.extend(group_devices)
+
+    inventory = LVMInventory.collect()
+    nested = set(_canonical_device('/dev/{}/{}'.format(lv['vg_name'],
+                                                       lv['lv_name']))
+                 for lv in inventory.lvs)
+    for pv in inventory.pvs:
+        device = _canonical_device(pv['pv_name'])
+        if pv.get('vg_name') in volume_groups:
+            devices.append(pv['pv_name'])
+        elif device not in nested and not inventory.is_remote(device):
+            devices.append(pv['pv_name'])
+
+    patterns = []
+    for device in devices:
+        for path in (device, _canonical_device(device)):
+            pattern = 'a|^{}$|'.format(_lvm_filter_escape(path))
+            if pattern not in patterns:
+                patterns.append(pattern)
+    if any(_parse_block_device(device)[1]
+           for group_devices in groups.values()
+           for device in group_devices):
+        patterns.append(LOOPBACK_FILTER)
+    return patterns + ['r|.*|']
+
+
+def _lvm_filter_escape(path):
+    """Escape the characters of a path which are special to LVM regexes."""
+    return ''.join('\\' + char if char in LVM_FILTER_SPECIAL_CHARS else char
+                   for char in path)
+
+
+def write_lvm_local_config(config):
+    """Update the charm managed block of the local LVM configuration.
+
+    Settings outside of the managed block are left untouched, and the file
+    is only written when the managed block changes.
+
+    :param config: dict: Mapping of LVM configuration sections to their
+                         settings. The managed block is removed if empty.
+    """
+    try:
+        with open(LVM_LOCAL_CONF) as f:
+            current = f.read()
+    except IOError:
+        current = ''
+
+    lines = current.splitlines()
+    if LVM_LOCAL_CONF_BEGIN in lines and LVM_LOCAL_CONF_END in lines:
+        begin = lines.index(LVM_LOCAL_CONF_BEGIN)
+        end = lines.index(LVM_LOCAL_CONF_END)
+        lines = lines[:begin] + lines[end + 1:]
+
+    if config:
+        lines.append(LVM_LOCAL_CONF_BEGIN)
+        for section in sorted(config):
+            lines.append('{} {{'.format(section))
+            for key, value in sorted(config[section].items()):
+                lines.append('    {} = {}'.format(
+                    key, _lvm_config_value(value)))
+            lines.append('}')
+        lines.append(LVM_LOCAL_CONF_END)
+
+    content = '\n'.join(lines) + '\n' if lines else ''
+    if content != current:
+        ch_hookenv.log('Updating {}'.format(LVM_LOCAL_CONF))
+        write_file(LVM_LOCAL_CONF, content)
+
+
+def _lvm_config_value(value):
+    """Format a value using the LVM configuration syntax."""
+    if isinstance(value, (list, tuple)):
+        return '[ {} ]'.format(', '.join(_lvm_config_value(v)
+                                         for v in value))
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return '"{}"'.format(value)
+
+
+def log_lvm_info(before):
+    """Log how the LVM setup changed while configuring storage.
+
+    Depending on the 'lvm-info-verbosity' option, nothing is logged
+    ('none'), only the differences between the state before and after
+    configuration are ('diff'), or both complete states are logged too
+    ('full'). All states are logged as JSON.
+
+    :param before: LVMInventory: Snapshot taken before configuration.
+    """
+    verbosity = ch_hookenv.config('lvm-info-verbosity') or 'diff'
+    if verbosity == 'none':
+        return
+
+    try:
+        after = LVMInventory.collect()
+    except subprocess.CalledProcessError as e:
+        ch_hookenv.log('Unable to report LVM state after configuration; may '
+                       'not be setup yet.  Error was: {}'.format(e))
+        return
+
+    if verbosity == 'full':
+        ch_hookenv.log('LVM state before configuration: {}'.format(
+            json.dumps(before.summary(), sort_keys=True)))
+        ch_hookenv.log('LVM state after configuration: {}'.format(
+            json.dumps(after.summary(), sort_keys=True)))
+    changes = diff_lvm_state(before.summary(), after.summary())
+    ch_hookenv.log('LVM state changes: {}'.format(
+        json.dumps(changes, sort_keys=True) if changes else 'none'))
+
+
+def diff_lvm_state(before, after):
+    """Compute the differences between two LVM state summaries.
+
+    :param before: dict: Summary as returned by LVMInventory.summary().
+    :param after: dict: Summary as returned by LVMInventory.summary().
+    :returns: dict: For each section (pvs, vgs, lvs) with changes, a dict
+                    mapping object names to their state before and after,
+                    None meaning the object did not exist.
+    """
+    changes = {}
+    for section in sorted(set(before) | set(after)):
+        old, new = before.get(section, {}), after.get(section, {})
+        changed = dict((name, {'before': old.get(name),
+                               'after': new.get(name)})
+                       for name in set(old) | set(new)
+                       if old.get(name) != new.get(name))
+        if changed:
+            changes[section] = changed
+    return changes
+
+
+def _lvm_report(command, report, fields, args=None):
+    """Run an LVM reporting command and return its rows.
+
+    :param command: str: LVM reporting command (pvs, vgs or lvs).
+    :param report: str: Name of the report section in the JSON output
+                        (pv, vg or lv).
+    :param fields: list: Fields to include in each row.
+    :param args: list: Extra arguments, such as the objects to report on.
+    :returns: list: List of dicts mapping field names to values.
+    """
+    cmd = [command, '--reportformat', 'json', '--units', 'b', '--nosuffix',
+           '--options', ','.join(fields)] + (args or [])
+    out = subprocess.check_output(cmd).decode('UTF-8')
+    rows = []
+    for section in json.loads(out).get('report', []):
+        rows.extend(section.get(report, []))
+    return rows
+
+
+def _to_number(value):
+    """Convert an LVM report value to an int or float, None if empty."""
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _canonical_device(device):
+    """Return the canonical kernel path of a device, resolving symlinks."""
+    return os.path.realpath(device)
+
+
+class LVMInventory(object):
+    """Point in time snapshot of the LVM and block device state of the unit.
+
+    The snapshot is collected with one pvs, vgs, lvs and lsblk invocation
+    each, independently of the number of devices configured, and is not
+    refreshed as devices are prepared.
+    """
+
+    PV_FIELDS = ['pv_name', 'vg_name', 'pv_uuid', 'pv_size', 'pv_free']
+    VG_FIELDS = ['vg_name', 'vg_uuid', 'vg_size', 'vg_free', 'pv_count',
+                 'vg_missing_pv_count']
+    LV_FIELDS = ['lv_name', 'vg_name', 'lv_attr', 'lv_size', 'pool_lv',
+                 'segtype',
+                 'data_percent', 'metadata_percent']
+    LSBLK_COLUMNS = ['NAME', 'TYPE', 'MOUNTPOINT', 'PTTYPE', 'TRAN']
+
+    def __init__(self, pvs=None, vgs=None, lvs=None, block_devices=None):
+        self.pvs = pvs or []
+        self.vgs = vgs or []
+        self.lvs = lvs or []
+        self.block_devices = block_devices or []
+        self._pvs = dict((_canonical_device(pv['pv_name']), pv)
+                         for pv in self.pvs)
+        self._block_devices = {}
+        self._index_block_devices(self.block_devices)
+
+    def _index_block_devices(self, block_devices, parent=None):
+        for block_device in block_devices:
+            if parent is not None and not block_device.get('tran'):
+                block_device = dict(block_device, tran=parent.get('tran'))
+            self._block_devices.setdefault(
+                _canonical_device(block_device['name']), block_device)
+            self._index_block_devices(block_device.get('children', []),
+                                      block_device)
+
+    @classmethod
+    @timed('lvm-inventory')
+    def collect(cls, devices=True):
+        """Collect a new snapshot of the LVM and block device state.
+
+        :param devices: bool: Whether to collect the PVs and block devices,
+                              or only the VGs and LVs.
+        :returns: LVMInventory: The collected snapshot.
+        :raises subprocess.CalledProcessError: if any of the reporting
+                                               commands fail.
+        """
+        if not devices:
+            return cls(vgs=_lvm_report('vgs', 'vg', cls.VG_FIELDS),
+                       lvs=_lvm_report('lvs', 'lv', cls.LV_FIELDS,
+                                       args=['--all']))
+        pvs = _lvm_report('pvs', 'pv', cls.PV_FIELDS)
+        vgs = _lvm_report('vgs', 'vg', cls.VG_FIELDS)
+        lvs = _lvm_report('lvs', 'lv', cls.LV_FIELDS, args=['--all'])
+        out = subprocess.check_output(
+            ['lsblk', '--json', '--paths',
+             '--output', ','.join(cls.LSBLK_COLUMNS)]).decode('UTF-8')
+        block_devices = json.loads(out).get('blockdevices', [])
+        return cls(pvs=pvs, vgs=vgs, lvs=lvs, block_devices=block_devices)
+
+    def summary(self):
+        """Summarize the state of PVs, VGs and LVs for reporting.
+
+        :returns: dict: JSON serializable dict with 'pvs', 'vgs' and 'lvs'
+                        sections, keyed by PV path, VG name and vg/lv name.
+        """
+        return {
+            'pvs': dict((pv['pv_name'], {
+                'vg': pv.get('vg_name', ''),
+                'size': _to_number(pv.get('pv_size')),
+                'free': _to_number(pv.get('pv_free')),
+            }) for pv in self.pvs),
+            'vgs': dict((vg['vg_name'], {
+                'size': _to_number(vg.get('vg_size')),
+                'free': _to_number(vg.get('vg_free')),
+                'pv_count': _to_number(vg.get('pv_count')),
+                'missing_pv_count': _to_number(
+                    vg.get('vg_missing_pv_count')),
+            }) for vg in self.vgs),
+            'lvs': dict(('{}/{}'.format(lv['vg_name'], lv['lv_name']), {
+                'attr': lv.get('lv_attr'),
+                'size': _to_number(lv.get('lv_size')),
+                'data_percent': _to_number(lv.get('data_percent')),
+                'metadata_percent': _to_number(lv.get('metadata_percent')),
+            }) for lv in self.lvs),
+        }
+
+    def thin_pools(self, volume_group):
+        """List the thin pools of a volume group.
+
+        :param volume_group: str: Name of volume group.
+        :returns: list: (pool, size) tuples, with the pool in vg/lv format
+                        and its size in bytes.
+        """
+        return [('{}/{}'.format(lv['vg_name'], lv['lv_name']),
+                 _to_number(lv.get('lv_size')) or 0)
+                for lv in self.lvs
+                if lv['vg_name'] == volume_group and
+                lv.get('lv_attr', '').startswith('t')]
+
+    def has_logical_volume(self, volume_group, name):
+        """Determine whether a logical volume exists, hidden ones included.
+
+        :param volume_group: str: Name of volume group.
+        :param name: str: Name of the logical volume.
+        """
+        return any(lv['vg_name'] == volume_group and
+                   lv['lv_name'].strip('[]') == name for lv in self.lvs)
+
+    def is_cached(self, pool):
+        """Determine whether the data of a thin pool is cached.
+
+        :param pool: str: Thin pool in vg/lv format.
+        """
+        volume_group, name = pool.split('/')
+        return any(lv['vg_name'] == volume_group and
+                   lv['lv_name'].strip('[]') == '{}_tdata'.format(name) and
+                   lv.get('segtype') in ('cache', 'writecache')
+                   for lv in self.lvs)
+
+    def is_physical_volume(self, device):
+        """Determine whether a device is initialized as an LVM PV.
+
+        :param device: str: Full path of the device.
+        :returns: bool: True if the device is a PV, False if not.
+        """
+        return _canonical_device(device) in self._pvs
+
+    def physical_volume(self, device):
+        """Return the report of a PV.
+
+        :param device: str: Full path of the device.
+        :returns: dict: PV fields, or None if the device is not a PV.
+        """
+        return self._pvs.get(_canonical_device(device))
+
+    def volume_group(self, device):
+        """Return the name of the volume group a PV belongs to.
+
+        :param device: str: Full path of the device.
+        :returns: str: Name of the volume group, empty if the device is not
+                       part of a volume group, or None if not a PV.
+        """
+        pv = self._pvs.get(_canonical_device(device))
+        if pv is None:
+            return None
+        return pv.get('vg_name', '')
+
+    def is_mounted(self, device):
+        """Determine whether a device, or anything on top of it, is mounted.
+
+        :param device: str: Full path of the device.
+        :returns: bool: True if mounted, False if not or if the device is
+                        not a known block device.
+        """
+        block_device = self._block_devices.get(_canonical_device(device))
+        return block_device is not None and self._has_mountpoint(
+            block_device)
+
+    def _has_mountpoint(self, block_device):
+        if block_device.get('mountpoint'):
+            return True
+        return any(self._has_mountpoint(child)
+                   for child in block_device.get('children', []))
+
+    def is_remote(self, device):
+        """Determine whether a device is on a disk attached over the network.
+
+        :param device: str: Full path of the device.
+        :returns: bool: True if the device, or the disk it is part of, is
+                        attached with one of REMOTE_TRANSPORTS.
+        """
+        block_device = self._block_devices.get(_canonical_device(device))
+        return bool(block_device and
+                    block_device.get('tran') in REMOTE_TRANSPORTS)
+
+    def has_partition_table(self, device):
+        """Determine whether a device carries an MBR or GPT partition table.
+
+        :param device: str: Full path of the device.
+        :returns: bool: True if a partition table is present, False if not.
+        """
+        block_device = self._block_devices.get(_canonical_device(device))
+        return bool(block_device and block_device.get('pttype'))
+
+
+class DevicePreparationError(Exception):
+    """Raised when one or more block devices could not be prepared."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(DevicePreparationError, self).__init__(
+            'Failed to prepare block devices: {}'.format(', '.join(
+                '{} ({})'.format(device, error)
+                for device, error in sorted(failures.items()))))
+
+
+def prepare_volumes(devices, concurrency=None, wipe='zap',
+                    physical_volumes=None):
+    '''Prepare block devices as LVM physical volumes, concurrently.
+
+    Each device is cleaned and initialized independently, so a failure on
+    one device does not prevent the others from being prepared.
+
+    :param devices: list: Full paths of the block devices to prepare.
+    :param concurrency: int: Maximum number of devices to prepare at once.
+                             Defaults to one worker per device, bounded by
+                             the number of CPUs.
+    :param wipe: str: How devices are wiped, see get_device_wipe().
+    :param physical_volumes: list: Devices already initialized as LVM PVs,
+                                   as known from an inventory. Each device
+                                   is probed if None.
+    :returns: (list, dict): Devices successfully prepared, in the order
+                            given, and a dict mapping the devices that
+                            failed to the exception raised.
+    '''
+    if not devices:
+        return [], {}
+    if not concurrency or concurrency < 1:
+        concurrency = os.cpu_count() or 1
+    concurrency = min(concurrency, len(devices))
+
+    failures = {}
+
+    def _prepare(device):
+        try:
+            prepare_volume(device, wipe, None if physical_volumes is None
+                           else device in physical_volumes)
+        except Exception as e:
+            ch_hookenv.log('Failed to prepare {}: {}'.format(device, e),
+                           level=ch_hookenv.ERROR)
+            failures[device] = e
+
+    if concurrency == 1:
+        for device in devices:
+            _prepare(device)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(_prepare, devices))
+
+    return [device for device in devices if device not in failures], failures
+
+
+@timed('prepare-volume')
+def prepare_volume(device, wipe='zap', is_pv=None):
     ch_hookenv.log("prepare_volume: {}".format(device))
-    clean_storage(device)
+    clean_storage(device, wipe, is_pv)
     create_lvm_physical_volume(device)
     ch_hookenv.log("prepared volume: {}".format(device))
 
 
-def has_partition_table(block_device):
-    out = subprocess.check_output(['gdisk', '-l', block_device],
-                                  stderr=subprocess.STDOUT).decode('UTF-8')
-    return ("MBR: not present" not in out) or ("GPT: not present" not in out)
-
-
-def clean_storage(block_device):
+def clean_storage(block_device, wipe='zap', is_pv=None):
     '''Ensures a block device is clean.  That is:
         - unmounted
         - any lvm volume groups are deactivated
@@ -294,6 +2224,10 @@ def clean_storage(block_device):
         - partition table wiped
 
     :param block_device: str: Full path to block device to clean.
+    :param wipe: str: 'zap' to wipe the partition table with sgdisk and dd,
+                      otherwise only the signatures are wiped, see
+                      wipe_signatures().
+    :param is_pv: bool: Whether the device is an LVM PV, probed if None.
     '''
     for mp, d in mounts():
         if d == block_device:
@@ -301,11 +2235,157 @@ def clean_storage(block_device):
                            'unmounting.' % (d, mp))
             umount(mp, persist=True)
 
-    if is_lvm_physical_volume(block_device):
+    if is_pv is None:
+        is_pv = is_lvm_physical_volume(block_device)
+    if is_pv:
         deactivate_lvm_volume_group(block_device)
         remove_lvm_physical_volume(block_device)
 
-    zap_disk(block_device)
+    if wipe == 'zap':
+        zap_disk(block_device)
+    else:
+        wipe_signatures(block_device)
+
+
+def wipe_signatures(block_device):
+    '''Wipe the file system, RAID and partition table signatures of a device.
+
+    Only the signatures are overwritten, and the whole device is discarded
+    if it supports discard, which is quick and leaves nothing to read back
+    on most SSDs.
+
+    :param block_device: str: Full path to block device to wipe.
+    '''
+    subprocess.check_call(['wipefs', '--all', block_device])
+    if supports_discard(block_device):
+        if subprocess.call(['blkdiscard', block_device]) != 0:
+            ch_hookenv.log('Unable to discard {}'.format(block_device),
+                           level=ch_hookenv.WARNING)
+
+
+def get_device_wipe():
+    '''Return how new devices are wiped before being used.
+
+    'zap' clears the partition table with sgdisk and dd, 'signatures' only
+    wipes signatures (see wipe_signatures()), and 'erase' also overwrites
+    the whole device with zeroes in the background (see start_erase()).
+
+    :returns: str: The wipe mode.
+    :raises ValueError: if the mode is invalid.
+    '''
+    wipe = ch_hookenv.config('device-wipe') or 'zap'
+    if wipe not in DEVICE_WIPE_MODES:
+        raise ValueError("Invalid device-wipe '{}', must be one of: "
+                         "{}".format(wipe, ', '.join(DEVICE_WIPE_MODES)))
+    return wipe
+
+
+def start_erase(volume_group, device):
+    '''Start erasing a new physical volume in the background.
+
+    All the extents of the PV are allocated to a temporary LV, so that no
+    volume can be created on them, and the LV is overwritten with zeroes by
+    a transient systemd service running at idle I/O priority. The progress
+    is recorded in a state file, from which an interrupted erase resumes.
+    The LV is removed by check_erases() once the erase completes.
+
+    :param volume_group: str: Name of the volume group of the PV.
+    :param device: str: Full path of the PV.
+    '''
+    lv = ERASE_LV_PREFIX + os.path.basename(_canonical_device(device))
+    subprocess.check_call(['lvcreate', '--yes', '--extents', '100%PVS',
+                           '--name', lv, volume_group, device])
+    os.makedirs(ERASE_STATE_DIR, exist_ok=True)
+    state = os.path.join(ERASE_STATE_DIR, '{}.json'.format(lv))
+    with open(state, 'w') as f:
+        json.dump({'device': device, 'volume-group': volume_group,
+                   'lv': lv, 'offset': 0, 'size': None, 'done': False}, f)
+    _run_erase(lv)
+
+
+def _run_erase(lv):
+    # A failed run leaves the transient unit behind, preventing a new one.
+    subprocess.call(['systemctl', 'reset-failed', lv])
+    subprocess.check_call([
+        'systemd-run', '--unit', lv,
+        '--property', 'IOSchedulingClass=idle',
+        'python3', os.path.join(ch_hookenv.charm_dir(), ERASE_SCRIPT),
+        os.path.join(ERASE_STATE_DIR, '{}.json'.format(lv))])
+
+
+def erase_jobs():
+    '''Return the state of the background erases.
+
+    :returns: list: Dicts with the 'device', 'volume-group', 'lv', the
+                    'offset' reached and 'size' in bytes, and whether the
+                    erase is 'done'.
+    '''
+    try:
+        names = sorted(os.listdir(ERASE_STATE_DIR))
+    except OSError:
+        return []
+    jobs = []
+    for name in names:
+        # Leave out the temporary files the erase writes its state to.
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(ERASE_STATE_DIR, name)) as f:
+                jobs.append(json.load(f))
+        except (IOError, ValueError):
+            continue
+    return jobs
+
+
+def check_erases():
+    '''Complete finished background erases and resume interrupted ones.
+
+    The LV of a finished erase is removed, and the PV given to the thin
+    pool if logical volumes are thin provisioned. An erase whose service
+    failed ERASE_MAX_FAILURES times in a row is not resumed anymore, until
+    its failed state is reset with 'systemctl reset-failed'.
+    '''
+    kv = unitdata.kv()
+    failures = dict(kv.get(ERASE_FAILURES_KEY) or {})
+    finished = False
+    for job in erase_jobs():
+        lv = job['lv']
+        if not job['done']:
+            if subprocess.call(['systemctl', 'is-active', '--quiet',
+                                lv]) == 0:
+                continue
+            if subprocess.call(['systemctl', 'is-failed', '--quiet',
+                                lv]) == 0:
+                if failures.get(lv, 0) >= ERASE_MAX_FAILURES:
+                    continue
+                failures[lv] = failures.get(lv, 0) + 1
+                ch_hookenv.log('Erase of {} failed, {} time(s)'.format(
+                    job['device'], failures[lv]), level=ch_hookenv.WARNING)
+                if failures[lv] >= ERASE_MAX_FAILURES:
+                    continue
+            else:
+                # Interrupted, or reset by the operator.
+                failures.pop(lv, None)
+            ch_hookenv.log('Resuming erase of {}'.format(job['device']))
+            _run_erase(lv)
+            continue
+        failures.pop(lv, None)
+        subprocess.check_call(['lvremove', '--yes', '{}/{}'.format(
+            job['volume-group'], lv)])
+        os.remove(os.path.join(ERASE_STATE_DIR, '{}.json'.format(lv)))
+        ch_hookenv.log('Erased {}'.format(job['device']))
+        if get_thin_pool_options():
+            thin_pools = LVMInventory.collect().thin_pools(
+                job['volume-group'])
+            if thin_pools:
+                extend_thin_pools(thin_pools, [job['device']])
+            else:
+                finished = True
+    kv.set(ERASE_FAILURES_KEY, failures)
+    if finished:
+        # Have the thin pools created from the erased devices.
+        kv.set(STORAGE_FINGERPRINT_KEY, None)
+        configure_block_devices()
 
 
 def filesystem_mounted(fs):
@@ -338,11 +2418,398 @@ def _parse_block_device(block_device):
         return ('/dev/{}'.format(block_device), 0)
 
 
+def get_loopback_options():
+    '''Return the loopback device options from the charm configuration.
+
+    :returns: dict: Loopback options.
+    :raises ValueError: if any of the options is invalid.
+    '''
+    options = {
+        'allocation': ch_hookenv.config('loopback-allocation') or 'sparse',
+        'direct-io': bool(ch_hookenv.config('loopback-direct-io')),
+        'block-size': ch_hookenv.config('loopback-block-size') or None,
+    }
+    if options['allocation'] not in LOOPBACK_ALLOCATIONS:
+        raise ValueError("Invalid loopback-allocation '{}', must be one of: "
+                         "{}".format(options['allocation'],
+                                     ', '.join(LOOPBACK_ALLOCATIONS)))
+    if (options['block-size'] and
+            options['block-size'] not in LOOPBACK_BLOCK_SIZES):
+        raise ValueError("Invalid loopback-block-size '{}', must be one of: "
+                         "{}".format(options['block-size'],
+                                     ', '.join(str(size) for size in
+                                               LOOPBACK_BLOCK_SIZES)))
+    return options
+
+
+def ensure_loopback_devices(loopbacks, options=None, concurrency=None):
+    '''Map the backing files of several loopback devices, concurrently.
+
+    :param loopbacks: list: (path, size) tuples of the backing files.
+    :param options: dict: Loopback options from get_loopback_options().
+    :param concurrency: int: Maximum number of files to set up at once.
+                             Defaults to one worker per file, bounded by
+                             the number of CPUs.
+    :returns: dict: Loopback device of each backing file.
+    '''
+    if not loopbacks:
+        return {}
+    if not concurrency or concurrency < 1:
+        concurrency = os.cpu_count() or 1
+    concurrency = min(concurrency, len(loopbacks))
+
+    def _ensure(loopback):
+        path, size = loopback
+        return path, ensure_loopback_device(path, str(size), options)
+
+    if concurrency == 1:
+        return dict(_ensure(loopback) for loopback in loopbacks)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(executor.map(_ensure, loopbacks))
+
+
+@timed('loopback')
+def ensure_loopback_device(path, size, options=None):
+    '''Ensure a loopback device is mapped to a backing file.
+
+    The backing file is created if missing, either sparse or fully
+    allocated up front so that it does not fragment as volumes are written.
+    Direct I/O keeps the data of the loopback device out of the page cache
+    of the backing file system; it is also switched on for devices that
+    are already mapped. The logical block size is only set when the device
+    is mapped, as changing it under an existing PV would corrupt it.
+
+    :param path: str: Full path of the backing file.
+    :param size: str: Size of the backing file, in bytes.
+    :param options: dict: Loopback options from get_loopback_options().
+    :returns: str: Full path of the loopback device (eg, /dev/loop0).
+    '''
+    options = options or {}
+    for device, backing_file in loopback_devices().items():
+        if backing_file == path:
+            if options.get('direct-io') and not _loopback_direct_io(device):
+                subprocess.check_call(
+                    ['losetup', '--direct-io=on', device])
+            return device
+
+    if not os.path.exists(path):
+        if options.get('allocation') == 'preallocate':
+            subprocess.check_call(['fallocate', '--length', size, path])
+        else:
+            subprocess.check_call(['truncate', '--size', size, path])
+
+    cmd = ['losetup', '--find', '--show']
+    if options.get('direct-io'):
+        cmd.append('--direct-io=on')
+    if options.get('block-size'):
+        cmd.extend(['--sector-size', str(options['block-size'])])
+    cmd.append(path)
+    return subprocess.check_output(cmd).decode('UTF-8').strip()
+
+
+def _loopback_direct_io(device):
+    try:
+        with open('/sys/block/{}/loop/dio'.format(
+                os.path.basename(device))) as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return False
+
+
+def evacuate_device(device, targets=None, bandwidth=None, chunk_size='1G',
+                    thin_pools=True, progress=None):
+    '''Move the data off a physical volume and remove it from its VG.
+
+    The allocated extents are moved with pvmove in chunks, so that progress
+    can be reported and the copy throttled by pausing between chunks. Once
+    empty, the PV is removed from the volume group and recorded as
+    evacuated, so that it is not added back until it is removed from the
+    configuration.
+
+    :param device: str: Full path of the PV to evacuate.
+    :param targets: list: PVs to move the extents to, any other PV of the
+                          volume group by default.
+    :param bandwidth: int: Average copy rate not to exceed, in MiB/s.
+    :param chunk_size: str: Amount of data moved by each pvmove (ex. 1G).
+    :param thin_pools: bool: Whether to move the data and metadata of thin
+                             pools. If not, the PV is left in the volume
+                             group when it holds any.
+    :param progress: callable: Called with a message after each chunk.
+    :returns: dict: 'volume-group', 'moved-extents', 'remaining-lvs' (the
+                    LVs left on the PV) and 'removed' (whether the PV was
+                    removed from the volume group).
+    :raises ValueError: if the device is not a PV of one of the charm's
+                        volume groups, or the other PVs lack space.
+    '''
+    targets = targets or []
+    _validate_lvm_size('chunk-size', chunk_size)
+    inventory = LVMInventory.collect()
+    volume_group = inventory.volume_group(device)
+    if volume_group not in [get_volume_group_name(group)
+                            for group in get_device_groups()]:
+        raise ValueError('{} is not a physical volume of a volume group of '
+                         'this charm'.format(device))
+    for target in targets:
+        if inventory.volume_group(target) != volume_group:
+            raise ValueError('{} is not a physical volume of {}'.format(
+                target, volume_group))
+
+    segments = _lvm_report('pvs', 'pv', ['pvseg_start', 'pvseg_size',
+                                         'lv_name', 'vg_extent_size'],
+                           args=['--segments', device])
+    extent_size = _to_number(segments[0]['vg_extent_size'])
+    to_move, remaining = [], set()
+    for segment in segments:
+        lv = segment['lv_name'].strip('[]')
+        if not lv:
+            continue
+        if not thin_pools and lv.endswith(('_tdata', '_tmeta')):
+            remaining.add(lv)
+            continue
+        to_move.append((_to_number(segment['pvseg_start']),
+                        _to_number(segment['pvseg_size'])))
+
+    total = sum(size for _, size in to_move)
+    vg = next(vg for vg in inventory.vgs if vg['vg_name'] == volume_group)
+    pv = inventory.physical_volume(device)
+    if total * extent_size > (_to_number(vg['vg_free']) -
+                              _to_number(pv['pv_free'])):
+        raise ValueError('Not enough free space in {} to move {} '
+                         'off'.format(volume_group, device))
+
+    chunk = max(1, bytes_from_string(chunk_size.upper()) // extent_size)
+    moved = 0
+    for start, size in to_move:
+        for first in range(start, start + size, chunk):
+            last = min(first + chunk, start + size) - 1
+            began = time.monotonic()
+            with TIMER.step('pvmove', device):
+                subprocess.check_call(
+                    ['pvmove', '{}:{}-{}'.format(device, first, last)] +
+                    targets)
+            moved += last - first + 1
+            if progress:
+                progress('Moved {} of {} extents off {} ({}%)'.format(
+                    moved, total, device, moved * 100 // total))
+            if bandwidth:
+                time.sleep(max(0, (last - first + 1) * extent_size /
+                               (bandwidth << 20) -
+                               (time.monotonic() - began)))
+
+    result = {
+        'volume-group': volume_group,
+        'moved-extents': moved,
+        'remaining-lvs': sorted(remaining),
+        'removed': False,
+    }
+    if remaining:
+        return result
+    subprocess.check_call(['vgreduce', volume_group, device])
+    kv = unitdata.kv()
+    evacuated = kv.get(EVACUATED_DEVICES_KEY) or []
+    kv.set(EVACUATED_DEVICES_KEY,
+           evacuated + [_canonical_device(device)])
+    kv.flush()
+    result['removed'] = True
+    return result
+
+
+def format_metrics(inventory, volume_groups):
+    '''Format the capacity of volume groups as Prometheus metrics.
+
+    :param inventory: LVMInventory: Snapshot of the LVM state.
+    :param volume_groups: list: Names of the volume groups to report on.
+    :returns: str: Metrics in the Prometheus text exposition format.
+    '''
+    samples = collections.defaultdict(list)
+    for vg in inventory.vgs:
+        if vg['vg_name'] not in volume_groups:
+            continue
+        labels = 'vg="{}"'.format(vg['vg_name'])
+        for metric, field in (('cinder_lvm_vg_size_bytes', 'vg_size'),
+                              ('cinder_lvm_vg_free_bytes', 'vg_free'),
+                              ('cinder_lvm_vg_pv_count', 'pv_count'),
+                              ('cinder_lvm_vg_missing_pv_count',
+                               'vg_missing_pv_count')):
+            samples[metric].append((labels, _to_number(vg.get(field))))
+    for lv in inventory.lvs:
+        if (lv['vg_name'] not in volume_groups or
+                not lv.get('lv_attr', '').startswith('t')):
+            continue
+        labels = 'vg="{}",pool="{}"'.format(lv['vg_name'], lv['lv_name'])
+        for metric, field in (
+                ('cinder_lvm_thin_pool_size_bytes', 'lv_size'),
+                ('cinder_lvm_thin_pool_data_percent', 'data_percent'),
+                ('cinder_lvm_thin_pool_metadata_percent',
+                 'metadata_percent')):
+            samples[metric].append((labels, _to_number(lv.get(field))))
+
+    lines = []
+    for metric, help_text in METRICS:
+        values = [(labels, value) for labels, value in samples[metric]
+                  if value is not None]
+        if not values:
+            continue
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} gauge'.format(metric))
+        lines.extend('{}{{{}}} {}'.format(metric, labels, value)
+                     for labels, value in values)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def write_metrics():
+    '''Write the capacity metrics for the Prometheus textfile collector.
+
+    The metrics are built from a single snapshot of the LVM state, and
+    written to the 'metrics-textfile-dir' directory, if it exists. The file
+    is replaced atomically so the collector never reads it half written.
+    '''
+    directory = ch_hookenv.config('metrics-textfile-dir')
+    if directory is None:
+        directory = DEFAULT_METRICS_DIR
+    if not directory:
+        return
+    if not os.path.isdir(directory):
+        ch_hookenv.log('Metrics directory {} does not exist, not writing '
+                       'metrics'.format(directory), level=ch_hookenv.DEBUG)
+        return
+    try:
+        inventory = LVMInventory.collect(devices=False)
+    except subprocess.CalledProcessError as e:
+        ch_hookenv.log('Unable to collect LVM metrics: {}'.format(e),
+                       level=ch_hookenv.WARNING)
+        return
+    content = format_metrics(inventory, [get_volume_group_name(group)
+                                         for group in get_device_groups()])
+    path = os.path.join(directory, METRICS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.rename(path + '.tmp', path)
+
+
+def run_benchmark(group=None, profiles=None, size='1G', runtime=30,
+                  iodepth=32):
+    '''Benchmark the volume group of a device group with fio.
+
+    A temporary logical volume is created the way Cinder would create a
+    volume, thin in the thin pool when logical volumes are thin provisioned
+    and thick otherwise, and removed once the profiles have run. A thin
+    volume is written in full before any read profile runs, as reading
+    unprovisioned blocks of a thin volume does not reach the devices.
+
+    :param group: str: Name of the device group, None for the default.
+    :param profiles: list: Names of BENCHMARK_PROFILES to run, all of them
+                           by default.
+    :param size: str: Size of the temporary logical volume (ex. 1G).
+    :param runtime: int: Seconds each profile runs for.
+    :param iodepth: int: Number of I/Os kept in flight.
+    :returns: OrderedDict: Results of each profile, see
+                           parse_fio_results().
+    :raises ValueError: if the device group, a profile or the size is
+                        invalid, or if the volume group does not exist.
+    '''
+    if group not in get_device_groups():
+        raise ValueError("Unknown device group '{}'".format(group))
+    profiles = profiles or list(BENCHMARK_PROFILES)
+    for profile in profiles:
+        if profile not in BENCHMARK_PROFILES:
+            raise ValueError("Invalid profile '{}', must be one of: "
+                             "{}".format(profile,
+                                         ', '.join(BENCHMARK_PROFILES)))
+    _validate_lvm_size('size', size)
+    volume_group = get_volume_group_name(group)
+    if not lvm_volume_group_exists(volume_group):
+        raise ValueError("Volume group {} does not exist".format(
+            volume_group))
+
+    missing = filter_installed_packages(['fio'])
+    if missing:
+        apt_install(missing, fatal=True)
+    thin = get_thin_pool_options() is not None
+    if thin:
+        cmd = ['lvcreate', '--yes', '--thin', '--virtualsize', size,
+               '--name', BENCHMARK_LV, '{}/{}'.format(
+                   volume_group, get_thin_pool_name(volume_group))]
+    else:
+        cmd = ['lvcreate', '--yes', '--size', size, '--name', BENCHMARK_LV,
+               volume_group]
+    lv = '{}/{}'.format(volume_group, BENCHMARK_LV)
+    # Clean up after a benchmark that was interrupted.
+    subprocess.call(['lvremove', '--yes', lv])
+    subprocess.check_call(cmd)
+    try:
+        device = '/dev/{}'.format(lv)
+        if thin and any(_benchmark_reads(BENCHMARK_PROFILES[profile])
+                        for profile in profiles):
+            _run_fio(device, 'fill', ['--rw=write', '--bs=1m'],
+                     ['--iodepth=4'])
+        results = collections.OrderedDict()
+        for profile in profiles:
+            results[profile] = parse_fio_results(_run_fio(
+                device, profile, BENCHMARK_PROFILES[profile],
+                ['--iodepth={}'.format(iodepth),
+                 '--runtime={}'.format(runtime), '--time_based']))
+        return results
+    finally:
+        # Failing here would hide the error of the benchmark itself.
+        if subprocess.call(['lvremove', '--yes', lv]) != 0:
+            ch_hookenv.log('Unable to remove {}'.format(lv),
+                           level=ch_hookenv.WARNING)
+
+
+def _benchmark_reads(profile_args):
+    """Determine whether fio arguments make it read, mixed workloads too."""
+    return any(arg.startswith('--rw=') and
+               ('read' in arg or arg.endswith('rw'))
+               for arg in profile_args)
+
+
+def _run_fio(device, name, profile_args, extra_args):
+    cmd = (['fio', '--name={}'.format(name), '--filename={}'.format(device),
+            '--direct=1', '--ioengine=libaio', '--group_reporting',
+            '--output-format=json'] + profile_args + extra_args)
+    ch_hookenv.log('Running {}'.format(' '.join(cmd)))
+    return subprocess.check_output(cmd).decode('UTF-8')
+
+
+def parse_fio_results(output):
+    '''Extract the IOPS, bandwidth and latencies from fio JSON output.
+
+    :param output: str: JSON output of a fio run with group reporting.
+    :returns: dict: For each of 'read' and 'write' that saw any I/O, a dict
+                    with 'iops', 'bandwidth-kib' (KiB/s) and the
+                    'latency-p50-us', 'latency-p99-us' and 'latency-p999-us'
+                    completion latency percentiles in microseconds.
+    '''
+    job = json.loads(output)['jobs'][0]
+    results = {}
+    for direction in ('read', 'write'):
+        stats = job.get(direction, {})
+        if not stats.get('total_ios'):
+            continue
+        result = {
+            'iops': round(stats['iops'], 1),
+            'bandwidth-kib': stats['bw'],
+        }
+        percentiles = stats.get('clat_ns', {}).get('percentile', {})
+        for percentile, name in BENCHMARK_PERCENTILES:
+            if percentile in percentiles:
+                result['latency-{}-us'.format(name)] = round(
+                    percentiles[percentile] / 1000.0, 1)
+        results[direction] = result
+    return results
+
+
 class CinderLVMCharm(
         charms_openstack.charm.CinderStoragePluginCharm):
 
     name = 'cinder_lvm'
     release = 'queens'
+    # Target helpers and protocols supported by the release, and the helper
+    # used by default, see get_target_options()
+    target_helpers = ('tgtadm', 'lioadm', 'scstadmin', 'iscsictl', 'nvmet')
+    target_protocols = ('iscsi', 'iser', 'nvmet_rdma')
+    default_target_helper = 'tgtadm'
     packages = []
     release_pkg = 'cinder-common'
     version_package = 'cinder-volume'
@@ -355,21 +2822,164 @@ class CinderLVMCharm(
         # unique backend names per host will not function well if
         # backend names are the same for all hosts, even if the
         # "volume_backend_name" is set to a unique value
-        return get_backend_name()
+        try:
+            return get_backend_name(next(iter(get_device_groups())))
+        except ValueError:
+            # Invalid device groups block the unit, see
+            # custom_assess_status_check().
+            return get_backend_name()
+
+    def custom_assess_status_check(self):
+        """Block the unit on invalid storage related configuration."""
+        error = self.storage_config_error()
+        if error:
+            return 'blocked', error
+        jobs = [job for job in erase_jobs() if not job['done']]
+        failures = unitdata.kv().get(ERASE_FAILURES_KEY) or {}
+        failed = [os.path.basename(job['device']) for job in jobs
+                  if failures.get(job['lv'], 0) >= ERASE_MAX_FAILURES]
+        if failed:
+            return 'blocked', ('Erase failed: {}, see the cinder-lvm-erase '
+                               'services'.format(', '.join(failed)))
+        erasing = ['{} {}%'.format(
+            os.path.basename(job['device']),
+            job['offset'] * 100 // job['size'] if job['size'] else 0)
+            for job in jobs]
+        if erasing:
+            return 'active', 'Unit is ready, erasing {}'.format(
+                ', '.join(erasing))
+        return None, None
+
+    def storage_config_error(self):
+        """Validate the storage related configuration.
+
+        :returns: str: Error of the first invalid option, or None.
+        """
+        for check in (get_device_groups, get_thin_pool_options,
+                      get_capacity_options, get_volume_clear_options,
+                      get_block_device_tuning, get_cache_options,
+                      get_loopback_options, self._check_lv_layout,
+                      self.target_options, get_device_wipe,
+                      get_image_volume_cache_options,
+                      get_volume_copy_options):
+            try:
+                check()
+            except ValueError as e:
+                return str(e)
+        return None
+
+    def check_erases(self):
+        """Complete or resume the background erases of new devices."""
+        check_erases()
+
+    def write_metrics(self):
+        """Refresh the capacity metrics of the volume groups."""
+        write_metrics()
+
+    def target_options(self):
+        """Return the volume target options supported by this release."""
+        return get_target_options(self.target_protocols,
+                                  self.target_helpers,
+                                  self.default_target_helper)
+
+    @staticmethod
+    def _check_lv_layout():
+        """Check the layout against the devices of every device group."""
+        layout = get_lv_layout_options()
+        if not layout:
+            return
+        for devices in get_device_groups().values():
+            if devices:
+                check_lv_layout(layout, len(devices))
+
+    def send_storage_backend_data(self):
+        """Publish one backend per device group to the cinder charm.
+
+        With a single device group this is left to the default
+        implementation. Otherwise every backend gets its own section in
+        cinder.conf, and all of them are enabled. Nothing is published
+        while the configuration is invalid, the unit is blocked instead.
+
+        Nothing is published by update-status either: neither the
+        configuration nor the relation data change in that hook, so what
+        the previous hook published still stands.
+        """
+        if ch_hookenv.hook_name() == 'update-status':
+            return
+        error = self.storage_config_error()
+        if error:
+            ch_hookenv.log('Not publishing the storage backends: {}'.format(
+                error), level=ch_hookenv.WARNING)
+            return
+        if len(get_device_groups()) == 1:
+            return super(CinderLVMCharm, self).send_storage_backend_data()
+
+        configurations = self.cinder_configurations()
+        sub_config = {
+            'cinder': {
+                '/etc/cinder/cinder.conf': {
+                    'sections': configurations,
+                },
+            },
+        }
+        endpoint = reactive.endpoint_from_flag('storage-backend.connected')
+        endpoint.configure_principal(
+            backend_name=','.join(configurations),
+            configuration=json.dumps(sub_config),
+            stateless=self.stateless)
 
     def cinder_configuration(self):
-        configure_block_devices()
+        """Return the backend configuration of the first device group."""
+        return next(iter(self.cinder_configurations().values()), [])
+
+    def cinder_configurations(self):
+        """Configure storage and return the configuration of every backend.
 
+        :returns: OrderedDict: Mapping of backend names to lists of tuples
+                               with the configuration options of each one,
+                               empty if the configuration is invalid, in
+                               which case storage is left as it is.
+        """
+        error = self.storage_config_error()
+        if error:
+            ch_hookenv.log('Not configuring storage: {}'.format(error),
+                           level=ch_hookenv.WARNING)
+            return collections.OrderedDict()
+        # The device filter only drops removed devices once they are not
+        # PVs of the volume groups anymore, and is otherwise unchanged.
+        configured = configure_block_devices()
+        write_lvm_local_config(get_lvm_local_config(
+            refresh_filter=configured))
+        configure_volume_copy_cgroup(get_volume_copy_options())
+        return collections.OrderedDict(
+            (get_backend_name(group), self.backend_configuration(group))
+            for group in get_device_groups())
+
+    def backend_configuration(self, group=None):
+        """Return the configuration of the backend of a device group.
+
+        :param group: str: Name of the device group, None for the default.
+        :return: list of tuples with the configuration options for this driver.
+        """
         driver_options = [
             ('volume_driver', VOLUME_DRIVER),
             ('volumes_dir', VOLUMES_DIR),
             ('volume_name_template', VOLUME_NAME_TEMPLATE),
-            ('volume_group', get_volume_group_name()),
-            ('volume_backend_name', get_backend_name()),
+            ('volume_group', get_volume_group_name(group)),
+            ('volume_backend_name', get_backend_name(group)),
             ('lvm_type', ch_hookenv.config('allocation-type')),
-            ('volume_clear', 'zero'),
-            ('volume_clear_size', ch_hookenv.config('erase-size')),
         ]
+        layout = get_lv_layout_options()
+        if layout and not get_thin_pool_options():
+            # Thick volumes are mirrored by Cinder itself.
+            driver_options.append(('lvm_mirrors', layout['mirrors']))
+        driver_options.extend(get_volume_clear_options())
+        driver_options.extend(get_capacity_options())
+        driver_options.extend(image_volume_cache_config(
+            get_volume_group_name(group), get_image_volume_cache_options()))
+        driver_options.extend(volume_copy_config(
+            get_device_groups().get(group, []), get_volume_copy_options()))
+        driver_options.extend(self.target_options())
 
         config_flags = ch_hookenv.config('config-flags')
         if config_flags:
@@ -380,15 +2990,23 @@ class CinderLVMCharm(
         return driver_options
 
 
-class CinderLVMCharmWallaby(CinderLVMCharm):
+class CinderLVMCharmRocky(CinderLVMCharm):
+
+    release = 'rocky'
+    target_helpers = CinderLVMCharm.target_helpers + ('spdk-nvmeof',)
+
+
+class CinderLVMCharmWallaby(CinderLVMCharmRocky):
 
     release = 'wallaby'
+    target_protocols = CinderLVMCharmRocky.target_protocols + ('nvmet_tcp',)
+    default_target_helper = 'lioadm'
 
-    def cinder_configuration(self):
+    def backend_configuration(self, group=None):
         """Add some extra configuration for Wallaby and on.
         :return: list of tuples with the configuration options for this driver.
         """
-        opts = super(CinderLVMCharmWallaby, self).cinder_configuration()
+        opts = super(CinderLVMCharmWallaby, self).backend_configuration(group)
 
         # From Wallaby and on, the default target_helper that comes with the
         # Ubuntu cinder package is not tgtadm (default for Cinder), and
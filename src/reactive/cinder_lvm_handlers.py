@@ -12,23 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import charms_openstack.charm
-import charms.reactive
+import time
 
-from charmhelpers.contrib.openstack.utils import os_release
-from charmhelpers.core.hookenv import (
+# Taken first, for the 'hook-profiling' option to time the imports.
+IMPORT_STARTED = time.time()
+
+import charms_openstack.charm  # noqa: E402
+import charms.reactive  # noqa: E402
+
+from charmhelpers.contrib.openstack.utils import os_release  # noqa: E402
+from charmhelpers.core.hookenv import (  # noqa: E402
     leader_get,
     leader_set,
     log,
 )
-from charmhelpers.fetch.ubuntu import (get_installed_version,
+from charmhelpers.fetch.ubuntu import (get_installed_version,  # noqa: E402
                                        apt_mark)
 # This charm's library contains all of the handler code associated with
 # this charm -- we will use the auto-discovery feature of charms.openstack
 # to get the definitions for the charm.
-import charms_openstack.bus
+import charms_openstack.bus  # noqa: E402
 charms_openstack.bus.discover()
 
+from charm.openstack import cinder_lvm  # noqa: E402
+cinder_lvm.profile_hook(IMPORT_STARTED)
+
 charms_openstack.charm.use_defaults(
     'charm.installed',
     'update-status',
@@ -43,6 +51,13 @@ def reinstall():
         charm.install()
 
 
+@charms.reactive.hook('update-status')
+def update_status():
+    with charms_openstack.charm.provide_charm_instance() as charm:
+        charm.check_erases()
+        charm.write_metrics()
+
+
 @charms.reactive.when('leadership.is_leader')
 @charms.reactive.when_any('charm.installed', 'upgrade-charm',
                           'storage-backend.connected')
@@ -0,0 +1,311 @@
+# Copyright 2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark configure_lvm_storage() against a fake LVM command layer.
+
+Every command the charm runs, directly or through charmhelpers, is answered
+by FakeLVM instead of being executed, after an optional per-command latency.
+For each scenario and number of devices the wall time, the number of
+commands run and the peak memory allocated are measured, and compared with
+a stored baseline:
+
+    python3 -m unit_tests.benchmarks.storage
+    python3 -m unit_tests.benchmarks.storage --devices 1,50 --latency 0.01
+    python3 -m unit_tests.benchmarks.storage --update-baseline
+
+Running more commands than the baseline is always reported as a regression,
+as the number of commands does not depend on the machine. Wall times are
+only compared when the latency and concurrency match the ones of the
+baseline.
+"""
+
+import argparse
+import collections
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import mock
+
+import charmhelpers.contrib.storage.linux.lvm as ch_lvm
+
+import charm.openstack.cinder_lvm as cinder_lvm
+
+
+VOLUME_GROUP = 'cinder-volumes'
+DEVICE_SIZE = 1 << 40
+DEFAULT_DEVICES = (1, 10, 100, 500)
+DEFAULT_LATENCY = 0.001
+# Fixed rather than the number of CPUs, so that wall times do not depend on
+# the machine as long as the fake commands dominate.
+DEFAULT_CONCURRENCY = 4
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Wall time increase tolerated before flagging a regression, relative and
+# absolute to avoid flagging the noise of short runs.
+TIME_TOLERANCE = 0.25
+TIME_SLACK = 0.05
+
+Scenario = collections.namedtuple('Scenario', ['name', 'description',
+                                               'existing'])
+
+# How many of the devices are already part of the volume group.
+SCENARIOS = (
+    Scenario('create', 'New volume group on new devices',
+             lambda count: 0),
+    Scenario('extend', 'Half of the devices added to the volume group',
+             lambda count: count // 2),
+    Scenario('unchanged', 'All devices already in the volume group',
+             lambda count: count),
+)
+
+
+class FakeLVM(object):
+    """Stateful stand-in for the LVM, lsblk and disk commands."""
+
+    def __init__(self, devices, existing=(), latency=0.0):
+        self.devices = list(devices)
+        self.latency = latency
+        self.pvs = dict((device, VOLUME_GROUP) for device in existing)
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def run(self, args):
+        """Run a command.
+
+        :returns: (int, bytes): Exit code and output of the command.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        command = os.path.basename(args[0])
+        with self._lock:
+            self.calls[command] += 1
+            handler = getattr(self, '_' + command.replace('-', '_'), None)
+            if handler is None:
+                return 0, b''
+            return handler(args[1:])
+
+    @staticmethod
+    def _report(section, rows):
+        return 0, json.dumps({'report': [{section: rows}]}).encode()
+
+    def _pvs(self, args):
+        return self._report('pv', [
+            {'pv_name': device, 'vg_name': vg, 'pv_uuid': 'uuid-' + device,
+             'pv_size': str(DEVICE_SIZE), 'pv_free': str(DEVICE_SIZE)}
+            for device, vg in sorted(self.pvs.items())])
+
+    def _vgs(self, args):
+        pvs = [device for device, vg in self.pvs.items() if vg]
+        if not pvs:
+            return self._report('vg', [])
+        return self._report('vg', [
+            {'vg_name': VOLUME_GROUP, 'vg_uuid': 'uuid-vg',
+             'vg_size': str(DEVICE_SIZE * len(pvs)),
+             'vg_free': str(DEVICE_SIZE * len(pvs)),
+             'pv_count': str(len(pvs)), 'vg_missing_pv_count': '0'}])
+
+    def _lvs(self, args):
+        return self._report('lv', [])
+
+    def _lsblk(self, args):
+        return 0, json.dumps({'blockdevices': [
+            {'name': device, 'type': 'disk', 'mountpoint': None,
+             'pttype': None} for device in self.devices]}).encode()
+
+    def _pvdisplay(self, args):
+        if args[-1] not in self.pvs:
+            return 5, b''
+        return 0, '  VG Name               {}\n'.format(
+            self.pvs[args[-1]]).encode()
+
+    def _pvcreate(self, args):
+        self.pvs[args[-1]] = ''
+        return 0, b''
+
+    def _vgcreate(self, args):
+        vg, devices = args[0], args[1:]
+        for device in devices:
+            self.pvs[device] = vg
+        return 0, b''
+
+    def _vgextend(self, args):
+        return self._vgcreate(args)
+
+    def _blockdev(self, args):
+        return 0, '{}\n'.format(DEVICE_SIZE // 512).encode()
+
+
+class FakePopen(object):
+    """Popen replacement running commands against a FakeLVM."""
+
+    def __init__(self, lvm, args, stdin=None, stdout=None, stderr=None,
+                 **kwargs):
+        self.lvm = lvm
+        self.args = args
+        self.stdout = stdout
+        self.returncode = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def communicate(self, input=None, timeout=None):
+        self.returncode, out = self.lvm.run(self.args)
+        return (out if self.stdout == subprocess.PIPE else None,
+                b'' if self.stdout == subprocess.PIPE else None)
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            self.communicate()
+        return self.returncode
+
+    poll = wait
+
+    def kill(self):
+        pass
+
+    terminate = kill
+
+
+def run_once(count, scenario, latency, concurrency=None):
+    """Configure storage once against a fresh FakeLVM.
+
+    :returns: (float, FakeLVM): Wall time in seconds and the FakeLVM used.
+    """
+    devices = ['/dev/bench{}'.format(i) for i in range(count)]
+    lvm = FakeLVM(devices, devices[:scenario.existing(count)], latency)
+    config = {'lvm-info-verbosity': 'diff'}
+    popen = functools.partial(FakePopen, lvm)
+    with mock.patch.object(subprocess, 'Popen', popen), \
+            mock.patch.object(ch_lvm, 'Popen', popen), \
+            mock.patch.object(cinder_lvm.ch_hookenv, 'log'), \
+            mock.patch.object(cinder_lvm.ch_hookenv, 'config',
+                              side_effect=config.get), \
+            mock.patch.object(cinder_lvm, 'mounts', return_value=[]), \
+            mock.patch.object(cinder_lvm, 'is_block_device',
+                              side_effect=lambda path: path in devices):
+        cinder_lvm.TIMER.reset()
+        start = time.perf_counter()
+        cinder_lvm.configure_lvm_storage(devices, VOLUME_GROUP,
+                                         concurrency=concurrency)
+        elapsed = time.perf_counter() - start
+    return elapsed, lvm
+
+
+def measure(count, scenario, latency, concurrency=None):
+    """Measure one scenario for a number of devices.
+
+    The peak memory is measured in a second run, as tracing allocations
+    slows the code down.
+    """
+    elapsed, lvm = run_once(count, scenario, latency, concurrency)
+    tracemalloc.start()
+    try:
+        run_once(count, scenario, 0.0, concurrency)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'seconds': round(elapsed, 4),
+        'commands': sum(lvm.calls.values()),
+        'by-command': dict(sorted(lvm.calls.items())),
+        'peak-kib': peak // 1024,
+    }
+
+
+def compare(results, baseline, latency, concurrency):
+    """Return the regressions of results against a baseline.
+
+    :returns: list: Messages describing each regression.
+    """
+    regressions = []
+    same_timing = (baseline.get('latency') == latency and
+                   baseline.get('concurrency') == concurrency)
+    for key, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(key)
+        if not base:
+            continue
+        if result['commands'] > base['commands']:
+            regressions.append('{}: {} commands, baseline {}'.format(
+                key, result['commands'], base['commands']))
+        if (same_timing and result['seconds'] >
+                base['seconds'] * (1 + TIME_TOLERANCE) + TIME_SLACK):
+            regressions.append('{}: {}s, baseline {}s'.format(
+                key, result['seconds'], base['seconds']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', default=','.join(
+        str(count) for count in DEFAULT_DEVICES),
+        help='Comma separated numbers of devices to simulate')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help='Seconds each fake command takes')
+    parser.add_argument('--concurrency', type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='Devices prepared at once (prepare-concurrency)')
+    parser.add_argument('--scenario', action='append',
+                        choices=[scenario.name for scenario in SCENARIOS],
+                        help='Scenarios to run, all by default')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='Baseline file to compare with')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Store the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    counts = [int(count) for count in args.devices.split(',')]
+    results = {}
+    print('{:<10} {:>7} {:>10} {:>9} {:>9}'.format(
+        'scenario', 'devices', 'seconds', 'commands', 'peak-KiB'))
+    for scenario in SCENARIOS:
+        if args.scenario and scenario.name not in args.scenario:
+            continue
+        for count in counts:
+            result = measure(count, scenario, args.latency, args.concurrency)
+            results['{}-{}'.format(scenario.name, count)] = result
+            print('{:<10} {:>7} {:>10.4f} {:>9} {:>9}'.format(
+                scenario.name, count, result['seconds'], result['commands'],
+                result['peak-kib']))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'latency': args.latency,
+                       'concurrency': args.concurrency,
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Baseline written to {}'.format(args.baseline))
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, ValueError):
+        print('No baseline to compare with')
+        return 0
+    regressions = compare(results, baseline, args.latency, args.concurrency)
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,6 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import mock
+import os
+import tempfile
+
 import charmhelpers
 import charm.openstack.cinder_lvm as cinder_lvm
 import charms_openstack.test_utils as test_utils
@@ -42,13 +47,16 @@ class MockLVM:
         self.vgroups = {}
         self.devices = []
         self.mount_points = {}   # Maps device paths to device objects.
+        self.lvs = []
 
     def reduce(self, group):
         self.vgroups.pop(group, None)
 
     def extend(self, group, device=None):
         dev_group = self.vgroups.setdefault(group, set())
-        if device:
+        if isinstance(device, list):
+            dev_group.update(device)
+        elif device:
             dev_group.add(device)
 
     def exists(self, group):
@@ -92,7 +100,7 @@ class MockLVM:
         dev = self.find_device(path)
         return dev is not None and dev.is_block()
 
-    def ensure_loopback_dev(self, path, size):
+    def ensure_loopback_dev(self, path, size, options=None):
         dev = self.find_device(path)
         if dev is not None:
             dev.attrs['size'] = size
@@ -115,10 +123,29 @@ class MockLVM:
         dev = self.find_device(device)
         return dev is not None and dev.has_partition_table()
 
+    def inventory(self):
+        pvs = []
+        for group, devs in self.vgroups.items():
+            pvs.extend({'pv_name': dev, 'vg_name': group} for dev in devs)
+        mounted = dict((v.path, k) for k, v in self.mount_points.items())
+        block_devices = [{'name': dev.path,
+                          'type': 'loop' if dev.is_loop() else 'disk',
+                          'mountpoint': mounted.get(dev.path),
+                          'pttype': 'gpt' if dev.has_partition_table()
+                          else None}
+                         for dev in self.devices]
+        return cinder_lvm.LVMInventory(pvs=pvs, lvs=self.lvs,
+                                       block_devices=block_devices)
+
+    def add_thin_pool(self, group, name, size):
+        self.lvs.append({'vg_name': group, 'lv_name': name,
+                         'lv_attr': 'twi-a-tz--', 'lv_size': str(size)})
+
     def reset(self):
         self.vgroups.clear()
         self.devices.clear()
         self.mount_points.clear()
+        del self.lvs[:]
 
 
 class TestCinderLVMCharm(test_utils.PatchHelper):
@@ -147,40 +174,49 @@ class TestCinderLVMCharm(test_utils.PatchHelper):
         self.patch_object(cinder_lvm, 'umount')
         self.patch_object(cinder_lvm, 'is_block_device')
         self.patch_object(cinder_lvm, 'zap_disk')
-        self.patch_object(cinder_lvm, 'is_device_mounted')
         self.patch_object(cinder_lvm, 'ensure_loopback_device')
         self.patch_object(cinder_lvm, 'create_lvm_physical_volume')
         self.patch_object(cinder_lvm, 'create_lvm_volume_group')
         self.patch_object(cinder_lvm, 'deactivate_lvm_volume_group')
         self.patch_object(cinder_lvm, 'is_lvm_physical_volume')
-        self.patch_object(cinder_lvm, 'list_lvm_volume_group')
-        self.patch_object(cinder_lvm, 'list_thin_logical_volume_pools')
         self.patch_object(cinder_lvm, 'filesystem_mounted')
         self.patch_object(cinder_lvm, 'lvm_volume_group_exists')
         self.patch_object(cinder_lvm, 'remove_lvm_volume_group')
         self.patch_object(cinder_lvm, 'ensure_lvm_volume_group_non_existent')
         self.patch_object(cinder_lvm, 'log_lvm_info')
-        self.patch_object(cinder_lvm, 'has_partition_table')
         self.patch_object(cinder_lvm, 'reduce_lvm_volume_group_missing')
         self.patch_object(cinder_lvm, 'extend_lvm_volume_group')
+        self.patch_object(cinder_lvm, 'extend_logical_volume_by_devices')
+        self.patch_object(cinder_lvm.LVMInventory, 'collect')
+        self.patch_object(cinder_lvm.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        self.patch_object(cinder_lvm, 'create_thin_pool')
+        self.patch_object(cinder_lvm, 'tune_thin_pool')
+        self.patch_object(cinder_lvm, 'write_thin_pool_profile')
+        self.patch_object(cinder_lvm, 'write_lvm_local_config')
+        self.patch_object(cinder_lvm, 'tune_block_devices')
+        self.patch_object(cinder_lvm, 'create_cache')
+        self.patch_object(cinder_lvm, 'settle_udev')
+        self.patch_object(cinder_lvm.TIMER, 'write_report')
+        self.patch_object(cinder_lvm, '_is_rotational', return_value=True)
 
         self.config.side_effect = cf
         cinder_lvm.mounts.side_effect = lvm.mounts
         cinder_lvm.umount.side_effect = lvm.umount
         cinder_lvm.is_block_device.side_effect = lvm.is_block_device
-        cinder_lvm.is_device_mounted.side_effect = lvm.is_device_mounted
         cinder_lvm.ensure_loopback_device.side_effect = lvm.ensure_loopback_dev
         cinder_lvm.create_lvm_volume_group.side_effect = lvm.extend
         cinder_lvm.is_lvm_physical_volume.return_value = False
-        cinder_lvm.list_lvm_volume_group.side_effect = lvm.list_vgroup
-        cinder_lvm.list_thin_logical_volume_pools.return_value = []
         cinder_lvm.filesystem_mounted.side_effect = lvm.fs_mounted
         cinder_lvm.lvm_volume_group_exists.side_effect = lvm.exists
         cinder_lvm.remove_lvm_volume_group.side_effect = lvm.remove
         cinder_lvm.ensure_lvm_volume_group_non_existent.side_effect = \
             lvm.ensure_non_existent
-        cinder_lvm.has_partition_table.side_effect = lvm.has_partition_table
         cinder_lvm.extend_lvm_volume_group.side_effect = lvm.extend
+        cinder_lvm.LVMInventory.collect.side_effect = lvm.inventory
+        self._kv = {}
+        self.kv.return_value.get.side_effect = self._kv.get
+        self.kv.return_value.set.side_effect = self._kv.__setitem__
         self._config['block-device'] = '/dev/sdb'
 
     def tearDown(self):
@@ -226,7 +262,7 @@ class TestCinderLVMCharm(test_utils.PatchHelper):
         charm.cinder_configuration()
         cinder_lvm.filesystem_mounted.assert_called()
         cinder_lvm.umount.assert_called()
-        self.assertFalse(cinder_lvm.is_device_mounted(ephemeral_path))
+        self.assertFalse(self.LVM.is_device_mounted(ephemeral_path))
 
     def test_cinder_lvm_block_dev_none(self):
         charm = self._patch_config_and_charm({'block-device': 'none'})
@@ -237,7 +273,7 @@ class TestCinderLVMCharm(test_utils.PatchHelper):
         self.LVM.add_device(self._config['block-device'], block=True)
         charm = self._patch_config_and_charm({})
         charm.cinder_configuration()
-        cinder_lvm.is_device_mounted.assert_called()
+        cinder_lvm.LVMInventory.collect.assert_called_once_with()
         cinder_lvm.zap_disk.assert_called()
         self.assertTrue(self.LVM.exists(cinder_lvm.get_volume_group_name()))
 
@@ -262,3 +298,1255 @@ class TestCinderLVMCharm(test_utils.PatchHelper):
             'config-flags': 'target_helper=tgtadm'})
         config3 = charm.cinder_configuration()
         self.assertIn(('target_helper', 'tgtadm'), config3)
+
+    def test_target_options(self):
+        charm = self._patch_config_and_charm({
+            'target-helper': 'nvmet', 'target-protocol': 'nvmet_tcp',
+            'target-secondary-ip-addresses': '10.0.0.2 fd00::2'})
+        config = charm.cinder_configuration()
+        self.assertIn(('target_helper', 'nvmet'), config)
+        self.assertIn(('target_protocol', 'nvmet_tcp'), config)
+        self.assertIn(('target_secondary_ip_addresses', '10.0.0.2,fd00::2'),
+                      config)
+        self.assertNotIn('target_port', dict(config))
+        charm = cinder_lvm.CinderLVMCharm()
+        self.assertEqual(charm.custom_assess_status_check()[0], 'blocked')
+
+        for config in ({'target-helper': 'iet'},
+                       {'target-helper': 'lioadm',
+                        'target-protocol': 'nvmet_rdma'},
+                       {'target-helper': 'lioadm', 'iscsi-iotype': 'blockio'},
+                       {'target-helper': 'tgtadm',
+                        'iscsi-write-cache': 'yes'},
+                       {'target-secondary-ip-addresses': '10.0.0.300'}):
+            self._config = self.DEFAULT_CONFIG.copy()
+            charm = self._patch_config_and_charm(config)
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertRegex(message, 'target|iscsi')
+
+        # Checked against the helper in effect, tgtadm by default before
+        # Wallaby, or recorded in the leader settings.
+        self._config = self.DEFAULT_CONFIG.copy()
+        self._config.update({'block-device': '/dev/sdb',
+                             'iscsi-iotype': 'blockio'})
+        self.leader_get.return_value = None
+        charm = cinder_lvm.CinderLVMCharm()
+        self.assertIsNone(charm.custom_assess_status_check()[0])
+        self.assertIn(('iscsi_iotype', 'blockio'), charm.target_options())
+        charm = cinder_lvm.CinderLVMCharmWallaby()
+        self.assertEqual(charm.custom_assess_status_check()[0], 'blocked')
+        self.leader_get.return_value = 'tgtadm'
+        self.assertIsNone(charm.custom_assess_status_check()[0])
+
+        # spdk-nvmeof is only available from Rocky.
+        self._config = self.DEFAULT_CONFIG.copy()
+        self._config.update({'block-device': '/dev/sdb',
+                             'target-helper': 'spdk-nvmeof',
+                             'target-protocol': 'nvmet_rdma'})
+        charm = cinder_lvm.CinderLVMCharm()
+        self.assertEqual(charm.custom_assess_status_check()[0], 'blocked')
+        charm = cinder_lvm.CinderLVMCharmRocky()
+        self.assertIsNone(charm.custom_assess_status_check()[0])
+
+    def test_cinder_lvm_skips_mounted_and_partitioned(self):
+        self.LVM.add_device('/dev/sdb', block=True, **{'partition-table': 1})
+        self.LVM.mount_path('/srv', '/dev/sdc', block=True)
+        charm = self._patch_config_and_charm(
+            {'block-device': '/dev/sdb /dev/sdc'})
+        charm.cinder_configuration()
+        cinder_lvm.LVMInventory.collect.assert_called_once_with()
+        cinder_lvm.zap_disk.assert_not_called()
+        self.assertFalse(self.LVM.exists(cinder_lvm.get_volume_group_name()))
+
+        # Checked again once the operator cleans the devices up.
+        self.assertIsNone(self._kv[cinder_lvm.STORAGE_FINGERPRINT_KEY])
+        self.LVM.find_device('/dev/sdb').attrs['partition-table'] = None
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.zap_disk.assert_called_once_with('/dev/sdb')
+
+    def test_cinder_lvm_prepare_failure(self):
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.add_device('/dev/sdc', block=True)
+
+        def zap(device):
+            if device == '/dev/sdb':
+                raise OSError('bad disk')
+
+        cinder_lvm.zap_disk.side_effect = zap
+        self._patch_config_and_charm({'block-device': '/dev/sdb /dev/sdc'})
+        with self.assertRaises(cinder_lvm.DevicePreparationError) as ctx:
+            cinder_lvm.configure_block_devices()
+        self.assertEqual(list(ctx.exception.failures), ['/dev/sdb'])
+        cinder_lvm.create_lvm_volume_group.assert_called_once_with(
+            cinder_lvm.get_volume_group_name(), '/dev/sdc')
+
+    def test_cinder_lvm_batched_extend(self):
+        vg = cinder_lvm.get_volume_group_name()
+        devices = ['/dev/sdb', '/dev/sdc', '/dev/sdd']
+        for device in devices:
+            self.LVM.add_device(device, block=True)
+        self.LVM.extend(vg, '/dev/sdb')
+        self.LVM.add_thin_pool('other-vg', 'pool', 100)
+        self.LVM.add_thin_pool(vg, 'pool', 100)
+        self._patch_config_and_charm({'block-device': ' '.join(devices)})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.create_lvm_volume_group.assert_not_called()
+        cinder_lvm.extend_lvm_volume_group.assert_called_once_with(
+            vg, ['/dev/sdc', '/dev/sdd'])
+        cinder_lvm.extend_logical_volume_by_devices.assert_called_once_with(
+            vg + '/pool', ['/dev/sdc', '/dev/sdd'])
+        self.assertEqual(self.LVM.vgroups[vg], set(devices))
+        cinder_lvm.log_lvm_info.assert_called_once()
+
+    def test_cinder_lvm_unchanged_storage_skipped(self):
+        self.LVM.add_device('/dev/sdb', block=True)
+        self._patch_config_and_charm({})
+        self.assertTrue(cinder_lvm.configure_block_devices())
+        self.assertIn(cinder_lvm.STORAGE_FINGERPRINT_KEY, self._kv)
+        cinder_lvm.settle_udev.assert_called_once_with()
+        self.assertFalse(cinder_lvm.configure_block_devices())
+        cinder_lvm.LVMInventory.collect.assert_called_once_with()
+        cinder_lvm.settle_udev.assert_called_once_with()
+
+        self._config['remove-missing'] = True
+        self.assertTrue(cinder_lvm.configure_block_devices())
+        self.assertEqual(cinder_lvm.LVMInventory.collect.call_count, 2)
+
+    def test_cinder_lvm_device_filter_reused(self):
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.patch_object(cinder_lvm, 'get_lvm_device_filter',
+                          return_value=['a|^/dev/sdb$|', 'r|.*|'])
+        charm = self._patch_config_and_charm({'lvm-device-filter': True})
+        charm.cinder_configuration()
+        self.assertEqual(cinder_lvm.get_lvm_device_filter.call_count, 2)
+        charm.cinder_configuration()
+        self.assertEqual(cinder_lvm.get_lvm_device_filter.call_count, 2)
+        cinder_lvm.write_lvm_local_config.assert_called_with(
+            {'devices': {'global_filter': ['a|^/dev/sdb$|', 'r|.*|']}})
+
+    def test_cinder_lvm_device_filter_dropped_when_disabled(self):
+        for device in ('/dev/sdb', '/dev/sdc'):
+            self.LVM.add_device(device, block=True)
+        self.patch_object(cinder_lvm, 'get_lvm_device_filter')
+        cinder_lvm.get_lvm_device_filter.side_effect = lambda: [
+            'a|^{}$|'.format(device)
+            for device in self._config['block-device'].split()] + ['r|.*|']
+        charm = self._patch_config_and_charm({'lvm-device-filter': True})
+        charm.cinder_configuration()
+        self._config['lvm-device-filter'] = False
+        charm.cinder_configuration()
+        cinder_lvm.write_lvm_local_config.assert_called_with({})
+        self._config['block-device'] = '/dev/sdb /dev/sdc'
+        charm.cinder_configuration()
+        self.assertEqual(self.LVM.vgroups[cinder_lvm.get_volume_group_name()],
+                         {'/dev/sdb', '/dev/sdc'})
+        # Storage is unchanged, but the filter has to accept the new PV.
+        self._config['lvm-device-filter'] = True
+        charm.cinder_configuration()
+        cinder_lvm.write_lvm_local_config.assert_called_with(
+            {'devices': {'global_filter': ['a|^/dev/sdb$|', 'a|^/dev/sdc$|',
+                                           'r|.*|']}})
+
+    def test_cinder_lvm_failed_storage_not_fingerprinted(self):
+        self.LVM.add_device('/dev/sdb', block=True)
+        cinder_lvm.zap_disk.side_effect = OSError('bad disk')
+        self._patch_config_and_charm({})
+        with self.assertRaises(cinder_lvm.DevicePreparationError):
+            cinder_lvm.configure_block_devices()
+        self.assertNotIn(cinder_lvm.STORAGE_FINGERPRINT_KEY, self._kv)
+
+    def test_cinder_lvm_thin_pool_created(self):
+        vg = cinder_lvm.get_volume_group_name()
+        self.LVM.add_device('/dev/sdb', block=True)
+        self._patch_config_and_charm({'allocation-type': 'thin',
+                                      'thin-pool-chunk-size': '512K'})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.create_thin_pool.assert_called_once_with(vg, {
+            'size': '95%', 'chunk-size': '512K', 'metadata-size': None,
+            'zero': True, 'discards': None, 'autoextend-threshold': 80,
+            'autoextend-percent': 20, 'layout': None}, None)
+        cinder_lvm.tune_thin_pool.assert_not_called()
+
+    def test_cinder_lvm_thin_pool_tuned(self):
+        vg = cinder_lvm.get_volume_group_name()
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.extend(vg, '/dev/sdb')
+        self.LVM.add_thin_pool(vg, cinder_lvm.get_thin_pool_name(vg), 100)
+        self._patch_config_and_charm({'allocation-type': 'thin',
+                                      'thin-pool-zero': False})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.create_thin_pool.assert_not_called()
+        cinder_lvm.write_thin_pool_profile.assert_called_once()
+        cinder_lvm.tune_thin_pool.assert_called_once_with(
+            vg + '/' + vg + '-pool', {
+                'size': '95%', 'chunk-size': None, 'metadata-size': None,
+                'zero': False, 'discards': None, 'autoextend-threshold': 80,
+                'autoextend-percent': 20, 'layout': None})
+
+    def test_thin_pool_options(self):
+        self._config['allocation-type'] = 'default'
+        self.assertIsNone(cinder_lvm.get_thin_pool_options())
+        self._config.update({'allocation-type': 'auto',
+                             'thin-pool-size': '2T',
+                             'thin-pool-discards': 'nopassdown'})
+        options = cinder_lvm.get_thin_pool_options()
+        self.assertEqual(options['size'], '2T')
+        self.assertEqual(options['discards'], 'nopassdown')
+
+        charm = self._patch_config_and_charm({})
+        self.assertEqual(charm.custom_assess_status_check(), (None, None))
+        for option, value in (('thin-pool-size', '101%'),
+                              ('thin-pool-size', '1.5G'),
+                              ('thin-pool-metadata-size', '1024'),
+                              ('thin-pool-discards', 'sometimes'),
+                              ('thin-pool-autoextend-threshold', 20),
+                              ('thin-pool-autoextend-percent', 0)):
+            charm = self._patch_config_and_charm({option: value})
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn(option, message)
+            self._config.update({'thin-pool-size': '2T',
+                                 'thin-pool-metadata-size': None,
+                                 'thin-pool-discards': None,
+                                 'thin-pool-autoextend-threshold': None,
+                                 'thin-pool-autoextend-percent': None})
+
+    def test_cinder_lvm_striped_thin_pool(self):
+        for device in ('/dev/sdb', '/dev/sdc', '/dev/sdd'):
+            self.LVM.add_device(device, block=True)
+        self._patch_config_and_charm({'allocation-type': 'thin',
+                                      'block-device': 'sdb sdc sdd',
+                                      'lv-layout': 'striped',
+                                      'lv-stripe-size': '256K'})
+        cinder_lvm.configure_block_devices()
+        options = cinder_lvm.create_thin_pool.call_args[0][1]
+        self.assertEqual(options['layout'], {
+            'type': 'striped', 'stripes': 3, 'stripe-size': '256K',
+            'mirrors': 1})
+
+    def test_lv_layout_options(self):
+        charm = self._patch_config_and_charm({'lv-layout': 'raid1'})
+        self.assertEqual(charm.custom_assess_status_check(),
+                         ('blocked', "lv-layout 'raid1' needs 2 physical "
+                                     "volumes, 1 available"))
+        charm = self._patch_config_and_charm({'block-device': 'sdb sdc'})
+        self.assertIn(('lvm_mirrors', 1), charm.cinder_configuration())
+
+        self._config['allocation-type'] = 'thin'
+        charm = self._patch_config_and_charm({
+            'block-device': 'sdb sdc sdd sde', 'lv-layout': 'raid10'})
+        self.assertEqual(charm.custom_assess_status_check(), (None, None))
+        self.assertNotIn('lvm_mirrors', dict(charm.cinder_configuration()))
+        self.assertEqual(cinder_lvm.check_lv_layout(
+            cinder_lvm.get_lv_layout_options(), 4)['stripes'], 2)
+        for config in ({'lv-layout': 'raid5'},
+                       {'lv-layout': 'raid10', 'lv-stripes': 3},
+                       {'lv-layout': 'striped', 'lv-stripes': 1},
+                       {'lv-layout': 'striped', 'lv-stripe-size': '64'},
+                       {'lv-layout': 'striped', 'allocation-type': 'default'}):
+            self._config = self.DEFAULT_CONFIG.copy()
+            self._config['block-device'] = 'sdb sdc sdd sde'
+            self._config['allocation-type'] = 'thin'
+            charm = self._patch_config_and_charm(config)
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn('lv-', message)
+
+    def test_loopback_options(self):
+        self.assertEqual(cinder_lvm.get_loopback_options(), {
+            'allocation': 'sparse', 'direct-io': False, 'block-size': None})
+        for option, value in (('loopback-allocation', 'thick'),
+                              ('loopback-block-size', 8192)):
+            charm = self._patch_config_and_charm({option: value})
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn(option, message)
+            self._config.update({'loopback-allocation': None,
+                                 'loopback-block-size': None})
+
+    def test_run_benchmark(self):
+        self.patch_object(cinder_lvm, 'apt_install')
+        self.patch_object(cinder_lvm, 'filter_installed_packages',
+                          return_value=['fio'])
+        self.patch_object(cinder_lvm.subprocess, 'call', return_value=0)
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        self.patch_object(cinder_lvm.subprocess, 'check_output')
+        self.check_output.return_value = json.dumps({'jobs': [{
+            'read': {'total_ios': 1000, 'iops': 5000.04, 'bw': 20000,
+                     'clat_ns': {'percentile': {'50.000000': 150000,
+                                                '99.900000': 2500000}}},
+            'write': {'total_ios': 0, 'iops': 0, 'bw': 0}}]}).encode()
+        vg = cinder_lvm.get_volume_group_name()
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.extend(vg, '/dev/sdb')
+        self._config['allocation-type'] = 'thin'
+
+        results = cinder_lvm.run_benchmark(profiles=['randread-4k'],
+                                           runtime=10)
+        self.assertEqual(results, {'randread-4k': {'read': {
+            'iops': 5000.0, 'bandwidth-kib': 20000,
+            'latency-p50-us': 150.0, 'latency-p999-us': 2500.0}}})
+        self.apt_install.assert_called_once_with(['fio'], fatal=True)
+        self.check_call.assert_called_once_with(
+            ['lvcreate', '--yes', '--thin', '--virtualsize', '1G',
+             '--name', 'cinder-lvm-benchmark', vg + '/' + vg + '-pool'])
+        self.call.assert_called_with(
+            ['lvremove', '--yes', vg + '/cinder-lvm-benchmark'])
+        fill, run = self.check_output.call_args_list
+        self.assertIn('--name=fill', fill[0][0])
+        self.assertIn('--runtime=10', run[0][0])
+
+        # The error of fio is not hidden by a failed clean up.
+        self.call.return_value = 5
+        error = cinder_lvm.subprocess.CalledProcessError
+        self.check_output.side_effect = error(1, 'fio')
+        with self.assertRaises(error) as ctx:
+            cinder_lvm.run_benchmark(profiles=['randread-4k'])
+        self.assertEqual(ctx.exception.cmd, 'fio')
+        self.check_output.side_effect = None
+
+        # Mixed workloads read too, write only ones do not need the fill.
+        self.filter_installed_packages.return_value = []
+        self.apt_install.reset_mock()
+        self.check_output.reset_mock()
+        cinder_lvm.run_benchmark(profiles=['mixed-4k'])
+        self.assertIn('--name=fill', self.check_output.call_args_list[0][0][0])
+        self.check_output.reset_mock()
+        cinder_lvm.run_benchmark(profiles=['seqwrite-1m'])
+        self.assertEqual(self.check_output.call_count, 1)
+        self.apt_install.assert_not_called()
+
+        for kwargs in ({'group': 'fast'}, {'profiles': ['randread-8k']},
+                       {'size': '1.5G'}):
+            with self.assertRaises(ValueError):
+                cinder_lvm.run_benchmark(**kwargs)
+
+    def test_evacuate_device(self):
+        vg = cinder_lvm.get_volume_group_name()
+        cinder_lvm.LVMInventory.collect.side_effect = None
+        cinder_lvm.LVMInventory.collect.return_value = cinder_lvm.LVMInventory(
+            pvs=[{'pv_name': '/dev/sdb', 'vg_name': vg, 'pv_free': '0'},
+                 {'pv_name': '/dev/sdc', 'vg_name': vg, 'pv_free': '4096'}],
+            vgs=[{'vg_name': vg, 'vg_free': '4096'}])
+        self.patch_object(cinder_lvm, '_lvm_report', return_value=[
+            {'pvseg_start': '0', 'pvseg_size': '3', 'vg_extent_size': '1024',
+             'lv_name': 'volume-1'},
+            {'pvseg_start': '3', 'pvseg_size': '1', 'vg_extent_size': '1024',
+             'lv_name': '[cinder-pool_tmeta]'}])
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        self.patch_object(cinder_lvm.time, 'sleep')
+        progress = mock.MagicMock()
+
+        result = cinder_lvm.evacuate_device('/dev/sdb', chunk_size='2K',
+                                            bandwidth=1, progress=progress)
+        self.assertEqual(result, {'volume-group': vg, 'moved-extents': 4,
+                                  'remaining-lvs': [], 'removed': True})
+        self.check_call.assert_has_calls([
+            mock.call(['pvmove', '/dev/sdb:0-1']),
+            mock.call(['pvmove', '/dev/sdb:2-2']),
+            mock.call(['pvmove', '/dev/sdb:3-3']),
+            mock.call(['vgreduce', vg, '/dev/sdb'])])
+        progress.assert_called_with('Moved 4 of 4 extents off /dev/sdb '
+                                    '(100%)')
+        self.assertEqual(self.sleep.call_count, 3)
+        self.assertEqual(self._kv[cinder_lvm.EVACUATED_DEVICES_KEY],
+                         ['/dev/sdb'])
+
+        self.check_call.reset_mock()
+        result = cinder_lvm.evacuate_device('/dev/sdb', thin_pools=False)
+        self.assertEqual(result['remaining-lvs'], ['cinder-pool_tmeta'])
+        self.assertFalse(result['removed'])
+        self.check_call.assert_called_once_with(['pvmove', '/dev/sdb:0-2'])
+
+        for device, kwargs in (('/dev/sdd', {}),
+                               ('/dev/sdb', {'targets': ['/dev/sdd']})):
+            with self.assertRaises(ValueError):
+                cinder_lvm.evacuate_device(device, **kwargs)
+
+    def test_cinder_lvm_evacuated_device_skipped(self):
+        vg = cinder_lvm.get_volume_group_name()
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.add_device('/dev/sdc', block=True)
+        self._kv[cinder_lvm.EVACUATED_DEVICES_KEY] = ['/dev/sdb', '/dev/sdd']
+        self._patch_config_and_charm({'block-device': 'sdb sdc'})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.create_lvm_volume_group.assert_called_once_with(
+            vg, '/dev/sdc')
+        self.assertEqual(self._kv[cinder_lvm.EVACUATED_DEVICES_KEY],
+                         ['/dev/sdb'])
+        self.assertEqual(cinder_lvm.get_device_groups(), {None: ['sdc']})
+
+        # A single device is left, mirroring it is impossible.
+        charm = self._patch_config_and_charm({'lv-layout': 'raid1'})
+        self.assertEqual(charm.custom_assess_status_check()[0], 'blocked')
+
+    def test_extend_thin_pools(self):
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        devices = ['/dev/sdc', '/dev/sdd']
+        cinder_lvm.extend_thin_pools(
+            [('vg/a', 200), ('vg/b', 100), ('vg/c', 100)], devices)
+        self.check_call.assert_has_calls([
+            mock.call(['lvextend', '--extents', '+50%PVS', 'vg/a'] + devices),
+            mock.call(['lvextend', '--extents', '+50%PVS', 'vg/b'] + devices),
+        ])
+        cinder_lvm.extend_logical_volume_by_devices.assert_called_once_with(
+            'vg/c', devices)
+
+    def test_capacity_options(self):
+        charm = self._patch_config_and_charm({
+            'max-over-subscription-ratio': 'auto',
+            'reserved-percentage': 10})
+        config = charm.cinder_configuration()
+        self.assertIn(('max_over_subscription_ratio', 'auto'), config)
+        self.assertIn(('reserved_percentage', 10), config)
+        for option, value in (('max-over-subscription-ratio', '0.5'),
+                              ('max-over-subscription-ratio', 'lots'),
+                              ('reserved-percentage', 101)):
+            charm = self._patch_config_and_charm({option: value})
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn(option, message)
+            self._config.update({'max-over-subscription-ratio': None,
+                                 'reserved-percentage': None})
+
+    def test_image_volume_cache_options(self):
+        charm = self._patch_config_and_charm({
+            'image-volume-cache': True, 'image-volume-cache-max-size': '200',
+            'image-volume-cache-max-count': 50})
+        config = charm.cinder_configuration()
+        self.assertIn(('image_volume_cache_enabled', True), config)
+        self.assertIn(('image_volume_cache_max_size_gb', 200), config)
+        self.assertIn(('image_volume_cache_max_count', 50), config)
+
+        # Sized from a volume group of 1000G with 100G free.
+        vg = cinder_lvm.get_volume_group_name()
+        cinder_lvm.LVMInventory.collect.side_effect = None
+        cinder_lvm.LVMInventory.collect.return_value = cinder_lvm.LVMInventory(
+            vgs=[{'vg_name': vg, 'vg_size': str(1000 << 30),
+                  'vg_free': str(100 << 30)}])
+        self._config.update({'image-volume-cache-max-size': None,
+                             'image-volume-cache-max-count': None})
+        self._kv[cinder_lvm.VOLUME_GROUP_SIZES_KEY] = None
+        cinder_lvm.LVMInventory.collect.reset_mock()
+        options = cinder_lvm.get_image_volume_cache_options()
+        self.assertEqual(cinder_lvm.image_volume_cache_config(vg, options),
+                         [('image_volume_cache_enabled', True),
+                          ('image_volume_cache_max_size_gb', 50)])
+        # Free space is only read again once storage is reconfigured.
+        cinder_lvm.LVMInventory.collect.return_value = cinder_lvm.LVMInventory(
+            vgs=[{'vg_name': vg, 'vg_size': str(1000 << 30),
+                  'vg_free': str(90 << 30)}])
+        self.assertEqual(cinder_lvm.image_volume_cache_config(vg, options),
+                         [('image_volume_cache_enabled', True),
+                          ('image_volume_cache_max_size_gb', 50)])
+        cinder_lvm.LVMInventory.collect.assert_called_once_with(devices=False)
+        self._kv[cinder_lvm.STORAGE_FINGERPRINT_KEY] = None
+        charm.cinder_configuration()
+        self.assertEqual(cinder_lvm.image_volume_cache_config(vg, options),
+                         [('image_volume_cache_enabled', True),
+                          ('image_volume_cache_max_size_gb', 45)])
+        self._config['allocation-type'] = 'thin'
+        self.assertEqual(cinder_lvm.image_volume_cache_config(vg, options),
+                         [('image_volume_cache_enabled', True),
+                          ('image_volume_cache_max_size_gb', 100)])
+        self.assertEqual(
+            cinder_lvm.image_volume_cache_config('missing', options),
+            [('image_volume_cache_enabled', True)])
+
+        for option, value in (('image-volume-cache-max-size', '10G'),
+                              ('image-volume-cache-max-size', '150%'),
+                              ('image-volume-cache-max-count', -1)):
+            charm = self._patch_config_and_charm({option: value})
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn(option, message)
+            self._config.update({'image-volume-cache-max-size': None,
+                                 'image-volume-cache-max-count': None})
+
+    def test_volume_copy_options(self):
+        self.patch_object(cinder_lvm, 'apt_install')
+        self.patch_object(cinder_lvm, 'filter_installed_packages',
+                          side_effect=lambda packages: packages)
+        charm = self._patch_config_and_charm({})
+        config = charm.cinder_configuration()
+        self.assertNotIn('volume_dd_blocksize', dict(config))
+        self.assertNotIn('volume_copy_bps_limit', dict(config))
+
+        cinder_lvm._is_rotational.return_value = False
+        config = charm.cinder_configuration()
+        self.assertIn(('volume_dd_blocksize', '4M'), config)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.patch_object(cinder_lvm, 'BLKIO_CGROUP_DIR', new=tmpdir)
+            charm = self._patch_config_and_charm({
+                'volume-copy-block-size': '8M',
+                'volume-copy-bps-limit': '100M'})
+            config = charm.cinder_configuration()
+            self.assertIn(('volume_dd_blocksize', '8M'), config)
+            self.assertIn(('volume_copy_bps_limit', 100 << 20), config)
+            self.assertIn(('volume_copy_blkio_cgroup_name',
+                           'cinder-volume-copy'), config)
+            self.apt_install.assert_called_once_with(['cgroup-tools'],
+                                                     fatal=True)
+            self.assertEqual(os.listdir(tmpdir), ['cinder-volume-copy'])
+
+            # Only checked again once the limit changes.
+            charm.cinder_configuration()
+            self.filter_installed_packages.assert_called_once_with(
+                ['cgroup-tools'])
+            self.filter_installed_packages.side_effect = None
+            self.filter_installed_packages.return_value = []
+            self._config['volume-copy-bps-limit'] = '50M'
+            charm.cinder_configuration()
+            self.assertEqual(self.filter_installed_packages.call_count, 2)
+            self.apt_install.assert_called_once_with(['cgroup-tools'],
+                                                     fatal=True)
+
+        # The blkio controller is gone with cgroup v2.
+        state, message = charm.custom_assess_status_check()
+        self.assertEqual(state, 'blocked')
+        self.assertIn('cgroup v1', message)
+        self._config['volume-copy-bps-limit'] = None
+        for option, value in (('volume-copy-block-size', '1MB'),
+                              ('volume-copy-bps-limit', 'fast'),
+                              ('volume-copy-cgroup', 'a/b')):
+            charm = self._patch_config_and_charm({option: value})
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn(option, message)
+            self._config.update({'volume-copy-block-size': None,
+                                 'volume-copy-bps-limit': None,
+                                 'volume-copy-cgroup': None})
+
+    def test_volume_clear_options(self):
+        self.patch_object(cinder_lvm, 'supports_discard')
+        self.supports_discard.side_effect = lambda dev: dev != '/dev/sdc'
+        charm = self._patch_config_and_charm({
+            'volume-clear-ionice': '-c3', 'erase-size': '50'})
+        config = charm.cinder_configuration()
+        self.assertIn(('volume_clear', 'zero'), config)
+        self.assertIn(('volume_clear_size', '50'), config)
+        self.assertIn(('volume_clear_ionice', '-c3'), config)
+        cinder_lvm.write_lvm_local_config.assert_called_with({})
+
+        charm = self._patch_config_and_charm({'volume-clear': 'discard'})
+        config = charm.cinder_configuration()
+        self.assertIn(('volume_clear', 'none'), config)
+        self.assertNotIn(('volume_clear_ionice', '-c3'), config)
+        cinder_lvm.write_lvm_local_config.assert_called_with(
+            {'devices': {'issue_discards': 1}})
+
+        for option, value in (('volume-clear', 'shred'),
+                              ('block-device', '/dev/sdb /dev/sdc')):
+            charm = self._patch_config_and_charm({option: value})
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn('volume-clear', message)
+
+    def test_block_device_tuning(self):
+        vg = cinder_lvm.get_volume_group_name()
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.add_device('/dev/sdc', block=True)
+        self.LVM.extend(vg, '/dev/sdb')
+        self._patch_config_and_charm({'block-device': '/dev/sdb /dev/sdc',
+                                      'io-scheduler': 'mq-deadline',
+                                      'read-ahead-kb': 4096,
+                                      'device-rotational': 'false'})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.tune_block_devices.assert_called_once_with(
+            ['/dev/sdb', '/dev/sdc'],
+            {'scheduler': 'mq-deadline', 'read_ahead_kb': '4096',
+             'rotational': '0'}, vg)
+
+        for option, value in (('device-rotational', 'maybe'),
+                              ('nr-requests', 0),
+                              ('read-ahead-kb', -1)):
+            charm = self._patch_config_and_charm({option: value})
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn(option, message)
+            self._config.update({'device-rotational': None,
+                                 'nr-requests': None,
+                                 'read-ahead-kb': None})
+
+    def test_cinder_lvm_cache_created(self):
+        vg = cinder_lvm.get_volume_group_name()
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.add_device('/dev/sdc', block=True)
+        self._patch_config_and_charm({'allocation-type': 'thin',
+                                      'cache-device': 'sdc'})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.create_lvm_volume_group.assert_called_once_with(
+            vg, '/dev/sdb')
+        cinder_lvm.extend_lvm_volume_group.assert_called_once_with(
+            vg, ['/dev/sdc'])
+        cinder_lvm.create_thin_pool.assert_called_once_with(
+            vg, mock.ANY, ['/dev/sdb'])
+        cinder_lvm.create_cache.assert_called_once_with(
+            '{}/{}-pool'.format(vg, vg), ['/dev/sdc'],
+            {'devices': ['sdc'], 'mode': 'writethrough',
+             'chunk-size': None}, False)
+
+    def test_cinder_lvm_cache_existing(self):
+        vg = cinder_lvm.get_volume_group_name()
+        pool = cinder_lvm.get_thin_pool_name(vg)
+        for device in ('/dev/sdb', '/dev/sdc', '/dev/sdd'):
+            self.LVM.add_device(device, block=True)
+        self.LVM.extend(vg, ['/dev/sdb', '/dev/sdc'])
+        self.LVM.add_thin_pool(vg, pool, 100)
+        self.LVM.lvs.append({'vg_name': vg, 'lv_name': '[{}_tdata]'.format(
+            pool), 'lv_attr': 'Cwi-aoC---', 'segtype': 'cache'})
+        self._patch_config_and_charm({'allocation-type': 'thin',
+                                      'block-device': '/dev/sdb /dev/sdd',
+                                      'cache-device': '/dev/sdc'})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.create_thin_pool.assert_not_called()
+        cinder_lvm.extend_logical_volume_by_devices.assert_called_once_with(
+            '{}/{}'.format(vg, pool), ['/dev/sdd'])
+        cinder_lvm.create_cache.assert_not_called()
+
+    def test_cache_options(self):
+        for config in ({'cache-device': 'sdc'},
+                       {'allocation-type': 'thin', 'cache-device': 'sdc',
+                        'cache-mode': 'writearound'},
+                       {'allocation-type': 'thin', 'cache-device': '/a|1G'},
+                       {'allocation-type': 'thin', 'cache-device': 'sdc',
+                        'cache-chunk-size': 'big'}):
+            self._config = self.DEFAULT_CONFIG.copy()
+            charm = self._patch_config_and_charm(config)
+            state, message = charm.custom_assess_status_check()
+            self.assertEqual(state, 'blocked')
+            self.assertIn('cache', message)
+
+    def test_device_groups(self):
+        self._config['block-device'] = 'sdb fast:nvme0n1 bulk:/dev/sdc sdd'
+        self.assertEqual(cinder_lvm.get_device_groups(), {
+            None: ['sdb', 'sdd'], 'fast': ['nvme0n1'], 'bulk': ['/dev/sdc']})
+        self.assertEqual(list(cinder_lvm.get_device_groups()),
+                         [None, 'fast', 'bulk'])
+        self.assertEqual(
+            cinder_lvm.get_device_groups('/dev/disk/by-path/pci-0:1.0'),
+            {None: ['/dev/disk/by-path/pci-0:1.0']})
+        self.assertEqual(cinder_lvm.get_device_groups('none'), {None: []})
+        self.assertEqual(cinder_lvm.get_volume_group_name('fast'),
+                         'cinder-volumes-test-alias-fast')
+        self.assertEqual(cinder_lvm.get_backend_name('fast'),
+                         'LVM-test-alias-fast')
+
+        charm = self._patch_config_and_charm({'block-device': 'Fast:sdb'})
+        state, message = charm.custom_assess_status_check()
+        self.assertEqual(state, 'blocked')
+        self.assertIn('Fast', message)
+
+    def test_device_patterns(self):
+        self.patch_object(cinder_lvm, '_disk_id_links', return_value=[
+            ('nvme-SAMSUNG_MZQL2_S1', '/dev/nvme0n1'),
+            ('nvme-SAMSUNG_MZQL2_S2', '/dev/nvme1n1'),
+            ('nvme-eui.0001', '/dev/nvme0n1'),
+            ('wwn-0x5000c500a', '/dev/sdb'),
+            ('wwn-0x5000c500b', '/dev/nvme1n1'),
+            ('scsi-SATA_ST4000', '/dev/sdb')])
+        self._config['block-device'] = (
+            'fast:nvme-SAMSUNG_MZQL2* wwn-0x5000c500a sd? '
+            '/dev/disk/by-id/scsi-SATA_*')
+        self.assertEqual(cinder_lvm.get_device_groups(), {
+            'fast': ['/dev/disk/by-id/nvme-SAMSUNG_MZQL2_S1',
+                     '/dev/disk/by-id/wwn-0x5000c500b'],
+            None: ['/dev/disk/by-id/wwn-0x5000c500a']})
+
+    def test_cinder_lvm_new_devices_logged(self):
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.add_device('/dev/sdc', block=True)
+        self._kv[cinder_lvm.CONSUMED_DEVICES_KEY] = ['/dev/sdb']
+        self._patch_config_and_charm({'block-device': '/dev/sdb /dev/sdc'})
+        self.patch_object(cinder_lvm.ch_hookenv, 'log')
+        cinder_lvm.configure_block_devices()
+        self.log.assert_any_call('New block devices: /dev/sdc')
+        self.assertEqual(self._kv[cinder_lvm.CONSUMED_DEVICES_KEY],
+                         ['/dev/sdb', '/dev/sdc'])
+
+    def test_cinder_lvm_device_groups(self):
+        for device in ('/dev/sdb', '/dev/sdc', '/dev/nvme0n1'):
+            self.LVM.add_device(device, block=True)
+        charm = self._patch_config_and_charm(
+            {'block-device': 'fast:nvme0n1 bulk:sdb bulk:sdc'})
+        configurations = charm.cinder_configurations()
+        self.assertEqual(list(configurations),
+                         ['LVM-test-alias-fast', 'LVM-test-alias-bulk'])
+        fast = dict(configurations['LVM-test-alias-fast'])
+        self.assertEqual(fast['volume_group'],
+                         'cinder-volumes-test-alias-fast')
+        self.assertEqual(fast['volume_backend_name'], 'LVM-test-alias-fast')
+        self.assertEqual(self.LVM.vgroups, {
+            'cinder-volumes-test-alias-fast': {'/dev/nvme0n1'},
+            'cinder-volumes-test-alias-bulk': {'/dev/sdb', '/dev/sdc'}})
+        self.assertEqual(charm.service_name, 'LVM-test-alias-fast')
+        self.assertEqual(charm.cinder_configuration(),
+                         configurations['LVM-test-alias-fast'])
+
+    def test_send_storage_backend_data(self):
+        self.patch_object(cinder_lvm.reactive, 'endpoint_from_flag',
+                          return_value=mock.MagicMock())
+        charm = self._patch_config_and_charm(
+            {'block-device': 'sdb fast:nvme0n1'})
+        charm.send_storage_backend_data()
+        self.endpoint_from_flag.assert_called_once_with(
+            'storage-backend.connected')
+        configure_principal = (
+            self.endpoint_from_flag.return_value.configure_principal)
+        configure_principal.assert_called_once_with(
+            backend_name='LVM-test-alias,LVM-test-alias-fast',
+            configuration=mock.ANY, stateless=False)
+        sections = json.loads(
+            configure_principal.call_args[1]['configuration'])[
+                'cinder']['/etc/cinder/cinder.conf']['sections']
+        self.assertEqual(list(sections),
+                         ['LVM-test-alias', 'LVM-test-alias-fast'])
+
+        # Nothing changed since the previous hook.
+        self.patch_object(cinder_lvm.ch_hookenv, 'hook_name',
+                          return_value='update-status')
+        cinder_lvm.LVMInventory.collect.reset_mock()
+        charm.send_storage_backend_data()
+        configure_principal.assert_called_once_with(
+            backend_name=mock.ANY, configuration=mock.ANY, stateless=False)
+        cinder_lvm.LVMInventory.collect.assert_not_called()
+
+    def test_invalid_config_not_applied(self):
+        self.patch_object(cinder_lvm.reactive, 'endpoint_from_flag')
+        self.LVM.add_device('/dev/sdb', block=True)
+        charm = self._patch_config_and_charm({
+            'allocation-type': 'thin', 'thin-pool-size': '101%'})
+        self.assertEqual(charm.cinder_configuration(), [])
+        charm.send_storage_backend_data()
+        cinder_lvm.LVMInventory.collect.assert_not_called()
+        cinder_lvm.write_lvm_local_config.assert_not_called()
+        self.endpoint_from_flag.assert_not_called()
+        state, message = charm.custom_assess_status_check()
+        self.assertEqual(state, 'blocked')
+        self.assertIn('thin-pool-size', message)
+
+    def test_prepare_volumes_concurrency(self):
+        devices = ['/dev/sd{}'.format(c) for c in 'bcdef']
+        prepared, failures = cinder_lvm.prepare_volumes(devices, 3)
+        self.assertEqual(prepared, devices)
+        self.assertEqual(failures, {})
+        self.assertEqual(cinder_lvm.zap_disk.call_count, len(devices))
+        self.assertEqual(cinder_lvm.prepare_volumes([], 3), ([], {}))
+
+    def test_prepare_volumes_known_physical_volumes(self):
+        self.patch_object(cinder_lvm, 'remove_lvm_physical_volume')
+        cinder_lvm.prepare_volumes(['/dev/sdb', '/dev/sdc'],
+                                   physical_volumes=['/dev/sdc'])
+        cinder_lvm.is_lvm_physical_volume.assert_not_called()
+        cinder_lvm.deactivate_lvm_volume_group.assert_called_once_with(
+            '/dev/sdc')
+        self.remove_lvm_physical_volume.assert_called_once_with('/dev/sdc')
+
+    def test_prepare_volumes_signatures(self):
+        self.patch_object(cinder_lvm, 'wipe_signatures')
+        cinder_lvm.prepare_volumes(['/dev/sdb'], wipe='signatures')
+        cinder_lvm.wipe_signatures.assert_called_once_with('/dev/sdb')
+        cinder_lvm.zap_disk.assert_not_called()
+
+    def test_cinder_lvm_erase(self):
+        vg = cinder_lvm.get_volume_group_name()
+        self.LVM.add_device('/dev/sdb', block=True)
+        self.LVM.add_device('/dev/sdc', block=True)
+        self.patch_object(cinder_lvm, 'wipe_signatures')
+        self.patch_object(cinder_lvm, 'start_erase')
+        self.patch_object(cinder_lvm, 'erase_jobs', return_value=[
+            {'device': '/dev/sdc', 'volume-group': vg,
+             'lv': 'cinder-lvm-erase-sdc', 'offset': 50, 'size': 200,
+             'done': False}])
+        charm = self._patch_config_and_charm({
+            'allocation-type': 'thin', 'device-wipe': 'erase',
+            'block-device': 'sdb sdc'})
+        cinder_lvm.configure_block_devices()
+        cinder_lvm.start_erase.assert_has_calls([
+            mock.call(vg, '/dev/sdb'), mock.call(vg, '/dev/sdc')])
+        cinder_lvm.create_thin_pool.assert_called_once_with(
+            vg, mock.ANY, ['/dev/sdb'])
+        self.assertEqual(charm.custom_assess_status_check(),
+                         ('active', 'Unit is ready, erasing sdc 25%'))
+        self._kv[cinder_lvm.ERASE_FAILURES_KEY] = {
+            'cinder-lvm-erase-sdc': cinder_lvm.ERASE_MAX_FAILURES}
+        self.assertEqual(charm.custom_assess_status_check(), (
+            'blocked', 'Erase failed: sdc, see the cinder-lvm-erase '
+                       'services'))
+
+        self._config['device-wipe'] = 'shred'
+        self.assertEqual(charm.custom_assess_status_check()[0], 'blocked')
+
+
+class TestLVMHelpers(test_utils.PatchHelper):
+
+    def test_create_thin_pool(self):
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        cinder_lvm.create_thin_pool('vg', {
+            'size': '90%', 'chunk-size': '64K', 'metadata-size': '1G',
+            'zero': False, 'discards': 'passdown'})
+        self.check_call.assert_called_once_with([
+            'lvcreate', '--yes', '--type', 'thin-pool',
+            '--metadataprofile', 'cinder-lvm-thin-pool',
+            '--extents', '90%FREE', '--chunksize', '64K',
+            '--poolmetadatasize', '1G', '--zero', 'n',
+            '--discards', 'passdown', '--name', 'vg-pool', 'vg'])
+
+    def test_create_raid_thin_pool(self):
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        cinder_lvm.create_thin_pool('vg', {
+            'size': '90%', 'zero': True, 'layout': {
+                'type': 'raid10', 'stripes': 2, 'stripe-size': None,
+                'mirrors': 1}})
+        self.check_call.assert_has_calls([
+            mock.call(['lvcreate', '--yes', '--type', 'raid1',
+                       '--mirrors', '1', '--size', '1G',
+                       '--name', 'vg-pool-meta', 'vg']),
+            mock.call(['lvcreate', '--yes', '--type', 'raid10',
+                       '--mirrors', '1', '--stripes', '2',
+                       '--extents', '90%FREE', '--name', 'vg-pool', 'vg']),
+            mock.call(['lvconvert', '--yes', '--type', 'thin-pool',
+                       '--poolmetadata', 'vg/vg-pool-meta',
+                       '--metadataprofile', 'cinder-lvm-thin-pool',
+                       '--zero', 'y', 'vg/vg-pool']),
+        ])
+
+    def test_ensure_loopback_device(self):
+        self.patch_object(cinder_lvm, 'loopback_devices',
+                          return_value={'/dev/loop0': '/srv/a.img'})
+        self.patch_object(cinder_lvm, '_loopback_direct_io',
+                          return_value=False)
+        self.patch_object(cinder_lvm.os.path, 'exists', return_value=False)
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        self.patch_object(cinder_lvm.subprocess, 'check_output',
+                          return_value=b'/dev/loop1\n')
+        options = {'allocation': 'preallocate', 'direct-io': True,
+                   'block-size': 4096}
+        self.assertEqual(cinder_lvm.ensure_loopback_devices(
+            [('/srv/a.img', 10), ('/srv/b.img', 20)], options, 2),
+            {'/srv/a.img': '/dev/loop0', '/srv/b.img': '/dev/loop1'})
+        self.check_call.assert_has_calls([
+            mock.call(['losetup', '--direct-io=on', '/dev/loop0']),
+            mock.call(['fallocate', '--length', '20', '/srv/b.img']),
+        ], any_order=True)
+        self.check_output.assert_called_once_with([
+            'losetup', '--find', '--show', '--direct-io=on',
+            '--sector-size', '4096', '/srv/b.img'])
+
+        self.check_call.reset_mock()
+        cinder_lvm.ensure_loopback_device('/srv/c.img', '30')
+        self.check_call.assert_called_once_with(
+            ['truncate', '--size', '30', '/srv/c.img'])
+
+    def test_step_timer(self):
+        self.patch_object(cinder_lvm.ch_hookenv, 'hook_name',
+                          return_value='config-changed')
+        timer = cinder_lvm.StepTimer()
+        with timer.step('vgextend', 'vg'):
+            pass
+        with self.assertRaises(cinder_lvm.subprocess.CalledProcessError):
+            with timer.step('prepare-volume', '/dev/sdb'):
+                raise cinder_lvm.subprocess.CalledProcessError(5, 'pvcreate')
+        timer.steps[1]['duration'] = 2.5
+        self.assertEqual([(step['step'], step['exit-code'])
+                          for step in timer.steps],
+                         [('vgextend', 0), ('prepare-volume', 5)])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.patch_object(cinder_lvm, 'TIMINGS_DIR', new=tmpdir)
+            self.patch_object(cinder_lvm, 'TIMINGS_KEPT', new=1)
+            timer.started -= 1
+            timer.write_report()
+            timer.reset()
+            timer.write_report()
+            self.assertEqual(len(os.listdir(tmpdir)), 1)
+            report = cinder_lvm.latest_timing_report()
+        self.assertEqual(report['steps'], [])
+        self.assertTrue(report['started'].endswith('+00:00'))
+        self.assertEqual(
+            cinder_lvm.format_timing_summary({
+                'hook': 'config-changed', 'duration': 3.0,
+                'slowest': {'step': 'prepare-volume', 'target': '/dev/sdb',
+                            'duration': 2.5}}),
+            'Storage configuration in config-changed hook took 3.0s, '
+            'slowest step: prepare-volume /dev/sdb (2.5s)')
+
+    def test_profile_hook(self):
+        self.patch_object(cinder_lvm.ch_hookenv, 'config', return_value=None)
+        self.patch_object(cinder_lvm.ch_hookenv, 'atexit')
+        self.patch_object(cinder_lvm.ch_hookenv, 'hook_name',
+                          return_value='update-status')
+        timer = cinder_lvm.StepTimer(title='Hook dispatch')
+        self.patch_object(cinder_lvm, 'HOOK_TIMER', new=timer)
+
+        class Handler(object):
+            def id(self):
+                return 'reactive/handlers.py:update_status'
+
+            def invoke(self):
+                return 'invoked'
+
+        self.patch_object(cinder_lvm.reactive.bus, 'Handler', new=Handler)
+        cinder_lvm.profile_hook(cinder_lvm.time.time())
+        self.atexit.assert_not_called()
+
+        self.config.return_value = True
+        cinder_lvm.profile_hook(cinder_lvm.time.time() - 2)
+        self.atexit.assert_called_once_with(mock.ANY)
+        self.assertEqual(Handler().invoke(), 'invoked')
+        self.assertEqual(
+            [(step['step'], step['target']) for step in timer.steps],
+            [('import', None),
+             ('dispatch', 'reactive/handlers.py:update_status')])
+        # Once the report is written, handlers are not timed anymore.
+        self.patch_object(timer, 'write_report')
+        self.atexit.call_args[0][0]()
+        timer.write_report.assert_called_once_with()
+        self.assertEqual(Handler().invoke(), 'invoked')
+        self.assertEqual(len(timer.steps), 2)
+        self.assertGreaterEqual(timer.steps[0]['duration'], 2)
+        self.assertTrue(cinder_lvm.format_timing_summary(
+            timer.report()).startswith(
+                'Hook dispatch in update-status hook took 2.'))
+
+    def test_is_rotational(self):
+        self.patch_object(cinder_lvm.ch_hookenv, 'config', return_value=None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.patch_object(cinder_lvm, '_sysfs_queue_dir',
+                              return_value=tmpdir)
+            with open(os.path.join(tmpdir, 'rotational'), 'w') as f:
+                f.write('0\n')
+            self.assertFalse(cinder_lvm._is_rotational('nvme0n1'))
+            self.assertTrue(cinder_lvm._is_rotational('/srv/cinder.img|5G'))
+            self.config.side_effect = {'device-rotational': 'true'}.get
+            self.assertTrue(cinder_lvm._is_rotational('nvme0n1'))
+        self.config.side_effect = None
+        self.assertTrue(cinder_lvm._is_rotational('nvme0n1'))
+
+    def test_wipe_signatures(self):
+        self.patch_object(cinder_lvm, 'supports_discard', return_value=True)
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        self.patch_object(cinder_lvm.subprocess, 'call', return_value=0)
+        cinder_lvm.wipe_signatures('/dev/sdb')
+        self.check_call.assert_called_once_with(
+            ['wipefs', '--all', '/dev/sdb'])
+        self.call.assert_called_once_with(['blkdiscard', '/dev/sdb'])
+
+    def test_erase(self):
+        self.patch_object(cinder_lvm.ch_hookenv, 'charm_dir',
+                          return_value='/charm')
+        self.patch_object(cinder_lvm.ch_hookenv, 'config')
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        self.patch_object(cinder_lvm.subprocess, 'call', return_value=3)
+        self.patch_object(cinder_lvm, 'LVMInventory')
+        self.patch_object(cinder_lvm, 'extend_thin_pools')
+        store = {}
+        self.patch_object(cinder_lvm.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        self.kv.return_value.get.side_effect = store.get
+        self.kv.return_value.set.side_effect = store.__setitem__
+        self.config.side_effect = {'allocation-type': 'thin'}.get
+        self.LVMInventory.collect.return_value.thin_pools.return_value = [
+            ('vg/vg-pool', 100)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.patch_object(cinder_lvm, 'ERASE_STATE_DIR', new=tmpdir)
+            cinder_lvm.start_erase('vg', '/dev/sdb')
+            state = os.path.join(tmpdir, 'cinder-lvm-erase-sdb.json')
+            self.check_call.assert_has_calls([
+                mock.call(['lvcreate', '--yes', '--extents', '100%PVS',
+                           '--name', 'cinder-lvm-erase-sdb', 'vg',
+                           '/dev/sdb']),
+                mock.call(['systemd-run', '--unit', 'cinder-lvm-erase-sdb',
+                           '--property', 'IOSchedulingClass=idle', 'python3',
+                           '/charm/files/cinder-lvm-erase', state])])
+
+            # Not running anymore, resumed.
+            self.check_call.reset_mock()
+            cinder_lvm.check_erases()
+            self.assertEqual(self.check_call.call_args[0][0][0],
+                             'systemd-run')
+
+            # The state being saved by the erase is not another job.
+            with open(state + '.tmp', 'w') as f:
+                f.write('{}')
+            self.assertEqual(len(cinder_lvm.erase_jobs()), 1)
+            os.remove(state + '.tmp')
+
+            # Failed runs are retried a few times, then left to the
+            # operator.
+            self.call.side_effect = lambda cmd: 0 if 'is-failed' in cmd else 3
+            for _ in range(cinder_lvm.ERASE_MAX_FAILURES + 2):
+                self.check_call.reset_mock()
+                cinder_lvm.check_erases()
+            self.check_call.assert_not_called()
+            self.assertEqual(store[cinder_lvm.ERASE_FAILURES_KEY],
+                             {'cinder-lvm-erase-sdb':
+                              cinder_lvm.ERASE_MAX_FAILURES})
+            self.call.side_effect = None
+            cinder_lvm.check_erases()
+            self.assertEqual(self.check_call.call_args[0][0][0],
+                             'systemd-run')
+            self.assertEqual(store[cinder_lvm.ERASE_FAILURES_KEY], {})
+
+            job = dict(cinder_lvm.erase_jobs()[0], done=True)
+            with open(state, 'w') as f:
+                json.dump(job, f)
+            self.check_call.reset_mock()
+            cinder_lvm.check_erases()
+            self.check_call.assert_called_once_with(
+                ['lvremove', '--yes', 'vg/cinder-lvm-erase-sdb'])
+            self.assertEqual(os.listdir(tmpdir), [])
+        self.extend_thin_pools.assert_called_once_with(
+            [('vg/vg-pool', 100)], ['/dev/sdb'])
+
+    def test_create_cache(self):
+        self.patch_object(cinder_lvm.subprocess, 'check_call')
+        cinder_lvm.create_cache('vg/vg-pool', ['/dev/nvme0n1'], {
+            'mode': 'writeback', 'chunk-size': '128K'})
+        self.check_call.assert_has_calls([
+            mock.call(['lvcreate', '--yes', '--type', 'cache-pool',
+                       '--chunksize', '128K', '--extents', '95%PVS',
+                       '--name', 'vg-cache', 'vg', '/dev/nvme0n1']),
+            mock.call(['lvconvert', '--yes', '--type', 'cache',
+                       '--cachepool', 'vg/vg-cache', '--cachemode',
+                       'writeback', 'vg/vg-pool'])])
+
+        self.check_call.reset_mock()
+        cinder_lvm.create_cache('vg/vg-pool', ['/dev/nvme0n1'], {
+            'mode': 'writecache'}, exists=True)
+        self.check_call.assert_called_once_with([
+            'lvconvert', '--yes', '--type', 'writecache',
+            '--cachevol', 'vg/vg-cache', 'vg/vg-pool'])
+
+    def test_tune_block_devices(self):
+        self.patch_object(cinder_lvm, 'write_file')
+        self.patch_object(cinder_lvm, '_stable_device_links',
+                          return_value={'/dev/sdb': '/dev/disk/by-id/wwn-1'})
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = os.path.join(tmp, 'sdc', 'queue')
+            os.makedirs(queue)
+            self.patch_object(cinder_lvm, '_sysfs_queue_dir')
+            self._sysfs_queue_dir.side_effect = lambda dev: queue.replace(
+                'sdc', os.path.basename(dev))
+            os.makedirs(self._sysfs_queue_dir('/dev/sdb'))
+            rules = os.path.join(tmp, 'vg.rules')
+            self.patch_object(cinder_lvm, 'UDEV_TUNING_RULES',
+                              new=os.path.join(tmp, '{}.rules'))
+
+            cinder_lvm.tune_block_devices(
+                ['/dev/sdb', '/dev/sdc'],
+                {'scheduler': 'none', 'nr_requests': '64'}, 'vg')
+            with open(os.path.join(queue, 'scheduler')) as f:
+                self.assertEqual(f.read(), 'none')
+            with open(os.path.join(queue, 'nr_requests')) as f:
+                self.assertEqual(f.read(), '64')
+            self.write_file.assert_called_once_with(rules, (
+                '# Managed by the cinder-lvm charm.\n'
+                'ACTION=="add|change", SUBSYSTEM=="block", '
+                'ENV{DEVTYPE}=="disk", '
+                'ENV{DEVLINKS}=="*/dev/disk/by-id/wwn-1|'
+                '*/dev/disk/by-id/wwn-1 *", '
+                'ATTR{queue/scheduler}="none", '
+                'ATTR{queue/nr_requests}="64"\n'
+                'ACTION=="add|change", SUBSYSTEM=="block", '
+                'ENV{DEVTYPE}=="disk", KERNEL=="sdc", '
+                'ATTR{queue/scheduler}="none", '
+                'ATTR{queue/nr_requests}="64"\n'))
+
+            with open(rules, 'w') as f:
+                f.write('')
+            cinder_lvm.tune_block_devices(['/dev/sdb'], {}, 'vg')
+            self.assertFalse(os.path.exists(rules))
+
+    def test_write_lvm_local_config(self):
+        self.patch_object(cinder_lvm, 'write_file')
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write('local {\n}\n')
+            f.flush()
+            self.patch_object(cinder_lvm, 'LVM_LOCAL_CONF', new=f.name)
+            cinder_lvm.write_lvm_local_config(
+                {'devices': {'issue_discards': 1,
+                             'global_filter': ['a|^/dev/sdb$|', 'r|.*|']}})
+            self.write_file.assert_called_once_with(f.name, (
+                'local {\n'
+                '}\n'
+                '# BEGIN cinder-lvm charm managed settings\n'
+                'devices {\n'
+                '    global_filter = [ "a|^/dev/sdb$|", "r|.*|" ]\n'
+                '    issue_discards = 1\n'
+                '}\n'
+                '# END cinder-lvm charm managed settings\n'))
+
+            f.seek(0)
+            f.write(self.write_file.call_args[0][1])
+            f.flush()
+            self.write_file.reset_mock()
+            cinder_lvm.write_lvm_local_config(
+                {'devices': {'issue_discards': 1,
+                             'global_filter': ['a|^/dev/sdb$|', 'r|.*|']}})
+            self.write_file.assert_not_called()
+            cinder_lvm.write_lvm_local_config({})
+            self.write_file.assert_called_once_with(f.name, 'local {\n}\n')
+
+    def test_get_lvm_device_filter(self):
+        config = {'block-device': 'sdb fast:nvme0n1 /var/lib/lvm.img|5G',
+                  'cache-device': 'fast:/dev/nvme1n1', 'alias': 'a',
+                  'allocation-type': 'thin', 'lvm-device-filter': True}
+        self.patch_object(cinder_lvm.ch_hookenv, 'config',
+                          side_effect=config.get)
+        self.patch_object(cinder_lvm, '_canonical_device',
+                          side_effect=lambda device: {
+                              '/dev/cinder-volumes-a/volume-1': '/dev/dm-3',
+                          }.get(device, device))
+        inventory = cinder_lvm.LVMInventory(
+            pvs=[{'pv_name': '/dev/sda2', 'vg_name': 'ubuntu-vg'},
+                 {'pv_name': '/dev/sdc', 'vg_name': 'cinder-volumes-a'},
+                 {'pv_name': '/dev/dm-3', 'vg_name': 'guest-vg'},
+                 {'pv_name': '/dev/sdd', 'vg_name': 'guest-vg'}],
+            lvs=[{'vg_name': 'cinder-volumes-a', 'lv_name': 'volume-1'}],
+            block_devices=[
+                {'name': '/dev/sda', 'tran': 'sata',
+                 'children': [{'name': '/dev/sda2'}]},
+                {'name': '/dev/sdd', 'tran': 'iscsi'}])
+        self.patch_object(cinder_lvm.LVMInventory, 'collect',
+                          return_value=inventory)
+        store = {}
+        self.patch_object(cinder_lvm.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        self.kv.return_value.get.side_effect = store.get
+        self.kv.return_value.set.side_effect = store.__setitem__
+        expected = {'devices': {
+            'global_filter': ['a|^/dev/sdb$|', 'a|^/dev/nvme0n1$|',
+                              'a|^/dev/nvme1n1$|', 'a|^/dev/sda2$|',
+                              'a|^/dev/sdc$|', 'a|^/dev/loop[0-9]+$|',
+                              'r|.*|']}}
+        self.assertEqual(cinder_lvm.get_lvm_local_config(), expected)
+        self.assertEqual(
+            cinder_lvm.get_lvm_local_config(refresh_filter=False), expected)
+        cinder_lvm.LVMInventory.collect.assert_called_once_with()
+        cinder_lvm.get_lvm_local_config()
+        self.assertEqual(cinder_lvm.LVMInventory.collect.call_count, 2)
+        self.assertEqual(cinder_lvm._lvm_filter_escape('/dev/disk/by-id/a.1'),
+                         '/dev/disk/by-id/a\\.1')
+
+
+class TestMetrics(test_utils.PatchHelper):
+
+    def test_format_metrics(self):
+        inventory = cinder_lvm.LVMInventory(
+            vgs=[{'vg_name': 'vg', 'vg_size': '1000', 'vg_free': '100',
+                  'pv_count': '2', 'vg_missing_pv_count': '0'},
+                 {'vg_name': 'other', 'vg_size': '5'}],
+            lvs=[{'vg_name': 'vg', 'lv_name': 'vg-pool', 'lv_attr': 'twi-a',
+                  'lv_size': '900', 'data_percent': '81.50',
+                  'metadata_percent': ''},
+                 {'vg_name': 'vg', 'lv_name': 'volume-1', 'lv_attr': 'Vwi-a',
+                  'lv_size': '10', 'data_percent': '1.00'}])
+        metrics = cinder_lvm.format_metrics(inventory, ['vg'])
+        self.assertIn('# TYPE cinder_lvm_vg_free_bytes gauge\n'
+                      'cinder_lvm_vg_free_bytes{vg="vg"} 100\n', metrics)
+        self.assertIn('cinder_lvm_thin_pool_data_percent{vg="vg",'
+                      'pool="vg-pool"} 81.5\n', metrics)
+        self.assertNotIn('other', metrics)
+        self.assertNotIn('volume-1', metrics)
+        self.assertNotIn('metadata_percent', metrics)
+        self.assertEqual(cinder_lvm.format_metrics(inventory, []), '')
+
+    def test_write_metrics(self):
+        self.patch_object(cinder_lvm.ch_hookenv, 'config')
+        self.patch_object(cinder_lvm.unitdata, 'kv',
+                          return_value=mock.MagicMock())
+        self.kv.return_value.get.return_value = None
+        self.patch_object(cinder_lvm.LVMInventory, 'collect',
+                          return_value=cinder_lvm.LVMInventory())
+        self.patch_object(cinder_lvm, 'format_metrics',
+                          return_value='metrics\n')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.config.side_effect = {'metrics-textfile-dir': tmpdir,
+                                       'alias': 'a'}.get
+            cinder_lvm.write_metrics()
+            self.assertEqual(os.listdir(tmpdir), ['cinder_lvm.prom'])
+            with open(os.path.join(tmpdir, 'cinder_lvm.prom')) as f:
+                self.assertEqual(f.read(), 'metrics\n')
+        self.format_metrics.assert_called_once_with(
+            mock.ANY, ['cinder-volumes-a'])
+
+        self.config.side_effect = {'metrics-textfile-dir': ''}.get
+        cinder_lvm.write_metrics()
+        self.collect.assert_called_once_with(devices=False)
+
+
+class TestLVMInventory(test_utils.PatchHelper):
+
+    REPORTS = {
+        'pvs': {'report': [{'pv': [
+            {'pv_name': '/dev/sdb', 'vg_name': 'cinder-volumes',
+             'pv_size': '1000', 'pv_free': '400'},
+            {'pv_name': '/dev/sdc', 'vg_name': ''}]}]},
+        'vgs': {'report': [{'vg': [{'vg_name': 'cinder-volumes',
+                                    'vg_size': '1000', 'vg_free': '400',
+                                    'pv_count': '1',
+                                    'vg_missing_pv_count': '0'}]}]},
+        'lvs': {'report': [{'lv': [{'vg_name': 'cinder-volumes',
+                                    'lv_name': 'pool', 'lv_attr': 'twi-a-tz--',
+                                    'lv_size': '600', 'data_percent': '12.50',
+                                    'metadata_percent': ''}]}]},
+        'lsblk': {'blockdevices': [
+            {'name': '/dev/sdb', 'type': 'disk', 'mountpoint': None,
+             'pttype': None},
+            {'name': '/dev/sdd', 'type': 'disk', 'mountpoint': None,
+             'pttype': 'gpt', 'children': [
+                 {'name': '/dev/sdd1', 'type': 'part',
+                  'mountpoint': '/srv', 'pttype': 'gpt'}]}]},
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.patch_object(cinder_lvm.subprocess, 'check_output')
+        self.check_output.side_effect = (
+            lambda cmd: json.dumps(self.REPORTS[cmd[0]]).encode('UTF-8'))
+
+    def test_collect(self):
+        inventory = cinder_lvm.LVMInventory.collect()
+        self.assertEqual(self.check_output.call_count, 4)
+        self.assertTrue(inventory.is_physical_volume('/dev/sdb'))
+        self.assertTrue(inventory.is_physical_volume('/dev/sdc'))
+        self.assertFalse(inventory.is_physical_volume('/dev/sdd'))
+        self.assertEqual(inventory.volume_group('/dev/sdb'),
+                         'cinder-volumes')
+        self.assertEqual(inventory.volume_group('/dev/sdc'), '')
+        self.assertIsNone(inventory.volume_group('/dev/sdd'))
+
+    def test_mounts_and_partitions(self):
+        inventory = cinder_lvm.LVMInventory.collect()
+        self.assertFalse(inventory.is_mounted('/dev/sdb'))
+        self.assertTrue(inventory.is_mounted('/dev/sdd'))
+        self.assertTrue(inventory.is_mounted('/dev/sdd1'))
+        self.assertFalse(inventory.is_mounted('/path/to/file'))
+        self.assertFalse(inventory.has_partition_table('/dev/sdb'))
+        self.assertTrue(inventory.has_partition_table('/dev/sdd'))
+
+    def test_summary(self):
+        summary = cinder_lvm.LVMInventory.collect().summary()
+        self.assertEqual(summary['pvs']['/dev/sdb'],
+                         {'vg': 'cinder-volumes', 'size': 1000, 'free': 400})
+        self.assertEqual(summary['pvs']['/dev/sdc'],
+                         {'vg': '', 'size': None, 'free': None})
+        self.assertEqual(summary['vgs']['cinder-volumes'],
+                         {'size': 1000, 'free': 400, 'pv_count': 1,
+                          'missing_pv_count': 0})
+        self.assertEqual(summary['lvs']['cinder-volumes/pool'],
+                         {'attr': 'twi-a-tz--', 'size': 600,
+                          'data_percent': 12.5, 'metadata_percent': None})
+
+    def test_diff_lvm_state(self):
+        before = {'pvs': {'/dev/sdb': {'vg': ''}}, 'vgs': {}, 'lvs': {}}
+        after = {'pvs': {'/dev/sdb': {'vg': 'vg0'}},
+                 'vgs': {'vg0': {'size': 10}}, 'lvs': {}}
+        self.assertEqual(cinder_lvm.diff_lvm_state(before, after), {
+            'pvs': {'/dev/sdb': {'before': {'vg': ''},
+                                 'after': {'vg': 'vg0'}}},
+            'vgs': {'vg0': {'before': None, 'after': {'size': 10}}}})
+        self.assertEqual(cinder_lvm.diff_lvm_state(after, after), {})